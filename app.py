@@ -2,10 +2,8 @@ import sys
 
 sys.path.append("./lib/python2.7/site-packages/")
 
-import fitbit
-import jinja2
 import logging
-import os
+import time
 import urllib
 import webapp2
 
@@ -13,30 +11,70 @@ from google.appengine.api import app_identity as app
 from google.appengine.ext import ndb
 from google.appengine.api import taskqueue
 from google.appengine.api import users
-from oauth2client.appengine import OAuth2Decorator
-from oauth2client.appengine import CredentialsNDBProperty
 from webapp2_extras import sessions
 
-import citibike
-import citifit
 import conf
+import ledger
+import stats
+import templates
+
+from lazy import LazyModule
+
+# Heavy modules only needed by some handlers, imported on first use to keep
+# instance start up fast.
+citibike = LazyModule('citibike')
+citifit = LazyModule('citifit')
+fitbit = LazyModule('fitbit')
+fetcher = LazyModule('fetcher')
+pytz = LazyModule('pytz')
+profiling = LazyModule('profiling')
+oauth = LazyModule('oauth')
+oauth2client_client = LazyModule('oauth2client.client')
+
+class CredentialsProperty(ndb.BlobProperty):
+    """
+    OAuth 2.0 credentials stored as JSON, as by the oauth2client
+    CredentialsNDBProperty, but only importing oauth2client once credentials
+    are read or written.
+    """
+    def _to_base_type(self, value):
+        if value is None:
+            return ''
+        return value.to_json()
+
+    def _from_base_type(self, value):
+        if not value:
+            return None
+        try:
+            return oauth2client_client.Credentials.new_from_json(value)
+        except ValueError:
+            return None
 
-oauth_decorator = OAuth2Decorator(
-    client_id=conf.GOOGLE_FIT_CLIENT_KEY,
-    client_secret=conf.GOOGLE_FIT_CLIENT_SECRET,
-    scope='https://www.googleapis.com/auth/fitness.activity.write')
+    def _is_set(self, entity):
+        """
+        Returns whether entity has credentials, without decoding them.
+        """
+        value = self._get_base_value(entity)
+        return value is not None and bool(value.b_val)
 
 class UserSettings(ndb.Model):
     """
-    Settings for a given user including citibike and fitibit credentials.
+    Settings for a given user including citibike and fitibit credentials. Keyed
+    by user id and cached in memcache, read through and written through by ndb.
     """
+    _use_cache = True
+    _use_memcache = True
+
     userid = ndb.StringProperty(required=True)
     citibike_username = ndb.StringProperty()
     citibike_password = ndb.StringProperty()
+    citibike_member_id = ndb.StringProperty()
     fitbit_key = ndb.StringProperty()
     fitbit_secret = ndb.StringProperty()
-    google_fit_credentials = CredentialsNDBProperty()
+    google_fit_credentials = CredentialsProperty()
     last_trip_id = ndb.IntegerProperty(default=0)
+    sync_checkpoint = ndb.JsonProperty()
+    profile_next_update = ndb.BooleanProperty(default=False)
 
     def is_logged_in_citibike(self):
         return self.citibike_username != None and self.citibike_password != None
@@ -45,7 +83,50 @@ class UserSettings(ndb.Model):
         return self.fitbit_key != None and self.fitbit_secret != None
 
     def is_logged_in_google_fit(self):
-        return self.google_fit_credentials != None
+        return UserSettings.google_fit_credentials._is_set(self)
+
+    @classmethod
+    def get_by_userid(cls, userid):
+        """
+        Gets the settings of a user by key. Settings stored before they were
+        keyed by user id are migrated on first read. Returns None if the user
+        has no settings.
+        """
+        settings = cls.get_by_id(userid)
+        if settings is None:
+            legacy = cls.query(cls.userid == userid).get()
+            if legacy is not None:
+                settings = cls._migrate(userid, legacy.key)
+        return settings
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _migrate(cls, userid, legacy_key):
+        """
+        Moves legacy settings, along with their update lock and trip records,
+        under a key named after the user id. Returns the settings already
+        migrated if the legacy settings are gone.
+        """
+        legacy = legacy_key.get()
+        if legacy is None:
+            return cls.get_by_id(userid)
+        settings = cls.get_by_id(userid)
+        if settings is not None:
+            return settings
+
+        logging.debug("Migrating settings for user: %s" % userid)
+        settings = cls(id=userid, **legacy.to_dict())
+        children = []
+        for child in ndb.Query(ancestor=legacy_key).fetch():
+            if child.key == legacy_key:
+                continue
+            values = child.to_dict()
+            children.append(child.__class__(id=child.key.id(),
+                                            parent=settings.key,
+                                            **values))
+        ndb.put_multi([settings] + children)
+        ndb.delete_multi(ndb.Query(ancestor=legacy_key).fetch(keys_only=True))
+        return settings
 
 class UserUpdateLock(ndb.Model):
     """
@@ -54,11 +135,163 @@ class UserUpdateLock(ndb.Model):
     userid = ndb.StringProperty(required=True)
     lock = ndb.BooleanProperty(default=False)
 
+class UpdateProfile(ndb.Model):
+    """
+    Profile of an update task for the user set as parent. Holds the raw pstats
+    dump and a summary of the hot spots.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    stats = ndb.BlobProperty(compressed=True)
+    summary = ndb.TextProperty()
+
+class TripRecord(ndb.Model):
+    """
+    Citibike trip parsed for a user, keyed by trip id with the user settings as
+    parent. Tracks the trip distance, the services it was delivered to or
+    parked for, and failed attempts by service as [attempts, retry_at]. Times
+    are stored as naive UTC datetimes.
+    """
+    start_station = ndb.IntegerProperty(required=True, indexed=False)
+    start_time = ndb.DateTimeProperty(required=True, indexed=False)
+    end_station = ndb.IntegerProperty(required=True, indexed=False)
+    end_time = ndb.DateTimeProperty(required=True, indexed=False)
+    duration = ndb.IntegerProperty(required=True, indexed=False)
+    distance = ndb.IntegerProperty(indexed=False)
+    delivered = ndb.StringProperty(repeated=True, indexed=False)
+    parked = ndb.StringProperty(repeated=True, indexed=False)
+    retries = ndb.JsonProperty(default={})
+
+class DeadTrip(ndb.Model):
+    """
+    Trip of the user set as parent that failed permanently, for the service
+    named service or for all services if None.
+    """
+    trip_id = ndb.IntegerProperty(required=True)
+    service = ndb.StringProperty(indexed=False)
+    reason = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class NdbTripLedger(ledger.TripLedger):
+    """
+    TripLedger persisting trips of a user as TripRecord entities and dead
+    letters as DeadTrip entities.
+    """
+    def __init__(self, user_key):
+        self.user_key = user_key
+
+    def last_trip_id(self):
+        q = TripRecord.query(ancestor=self.user_key).order(-TripRecord.key)
+        key = q.get(keys_only=True)
+        q = DeadTrip.query(ancestor=self.user_key).order(-DeadTrip.trip_id)
+        dead = q.get()
+        return max(key.id() if key else 0, dead.trip_id if dead else 0)
+
+    def entries(self, min_id=0):
+        q = TripRecord.query(ancestor=self.user_key)
+        if min_id > 0:
+            q = q.filter(TripRecord.key > self._key(min_id))
+        q = q.order(TripRecord.key)
+        return [self._to_entry(record) for record in q.fetch()]
+
+    def add(self, trip, distance):
+        entry = ledger.LedgerEntry(trip, distance)
+        self._to_record(entry).put()
+        return entry
+
+    def save(self, entry):
+        self._to_record(entry).put()
+
+    def park(self, trip_id, service_name, reason):
+        id = '%d-%s' % (trip_id, service_name or 'all')
+        DeadTrip(id=id, parent=self.user_key, trip_id=trip_id,
+                 service=service_name, reason=reason).put()
+
+    def dead_letters(self):
+        q = DeadTrip.query(ancestor=self.user_key).order(-DeadTrip.trip_id)
+        return [ledger.DeadLetter(d.trip_id, d.service, d.reason)
+                for d in q.fetch()]
+
+    def _key(self, trip_id):
+        return ndb.Key(TripRecord, trip_id, parent=self.user_key)
+
+    def _to_record(self, entry):
+        def to_utc(dt):
+            return dt.astimezone(pytz.utc).replace(tzinfo=None)
+
+        trip = entry.trip
+        return TripRecord(key=self._key(trip.id),
+                          start_station=trip.start_station,
+                          start_time=to_utc(trip.start_time),
+                          end_station=trip.end_station,
+                          end_time=to_utc(trip.end_time),
+                          duration=trip.duration,
+                          distance=entry.distance,
+                          delivered=sorted(entry.delivered),
+                          parked=sorted(entry.parked),
+                          retries=entry.retries)
+
+    def _to_entry(self, record):
+        def from_utc(dt):
+            dt = pytz.utc.localize(dt)
+            return dt.astimezone(pytz.timezone('US/Eastern'))
+
+        trip = citibike.Trip(record.key.id(),
+                             record.start_station,
+                             from_utc(record.start_time),
+                             record.end_station,
+                             from_utc(record.end_time),
+                             record.duration)
+        return ledger.LedgerEntry(trip, record.distance, record.delivered,
+                                  record.parked, record.retries)
+
+class UserRideStats(ndb.Model):
+    """
+    Ride statistics of the user set as parent, stored under a single key so
+    they are read with one get.
+    """
+    totals = ndb.JsonProperty(indexed=False)
+    weeks = ndb.JsonProperty(compressed=True)
+    months = ndb.JsonProperty(compressed=True)
+    pairs = ndb.JsonProperty(compressed=True)
+
+class NdbRideStats(stats.RideStats):
+    """
+    RideStats persisted as the UserRideStats entity of a user.
+    """
+    KEY_ID = 'stats'
+
+    def __init__(self, user_key, load=True):
+        """
+        Loads the stats of the user unless load is False, in which case they
+        start from zero.
+        """
+        self.key = ndb.Key(UserRideStats, NdbRideStats.KEY_ID, parent=user_key)
+        record = self.key.get() if load else None
+        if record:
+            stats.RideStats.__init__(self, record.totals, record.weeks,
+                                     record.months, record.pairs)
+        else:
+            stats.RideStats.__init__(self)
+
+    def save(self):
+        if not self.changed:
+            return
+        UserRideStats(key=self.key,
+                      totals=self.totals,
+                      weeks=self.weeks,
+                      months=self.months,
+                      pairs=self.pairs).put()
+        self.changed = False
+
 class Update(webapp2.RequestHandler):
     """
     Update handler. Called through cron to update all users with their latest
     Citibike trips.
     """
+    # Time given to an update task before it checkpoints and continues in a
+    # new task, well within the 10 minutes task deadline.
+    UPDATE_BUDGET = 8 * 60
+
     def get(self):
         """
         Updates all users, enqueuing one task per user in the default task
@@ -67,52 +300,211 @@ class Update(webapp2.RequestHandler):
         q = UserSettings.query()
         users = q.fetch()
         for user in users:
+            if user.key.id() != user.userid:
+                user = UserSettings.get_by_userid(user.userid)
             self._enqueue(user)
 
     def post(self):
         """
         Updates user with userid passed as param. Release the update lock for
-        that user if successful.
+        that user if successful. If the update runs out of time, enqueues a
+        continuation task instead which keeps holding the lock.
         """
+        deadline = time.time() + Update.UPDATE_BUDGET
         userid = self.request.get('userid')
-        user = UserSettings.query(UserSettings.userid == userid).get()
+        user = UserSettings.get_by_userid(userid)
         if not user:
             logging.debug("Invalid user: %s" % userid)
             return
 
         logging.debug("Updating user: %s" % userid)
+        if user.profile_next_update:
+            complete = self._profiled_update(user, deadline)
+        else:
+            complete = self._update(user, deadline)
+        if not complete:
+            self._continue(user)
+            return
+
+        self._unlock(user)
+
+    def _update(self, user, deadline):
+        """
+        Updates user until deadline, saving the last trip id, the checkpoint
+        to resume from and the Citibike member id. Returns whether the update
+        completed.
+        """
         cf = citifit.Citifit(user.citibike_username,
-                             user.citibike_password)
+                             user.citibike_password,
+                             NdbTripLedger(user.key),
+                             NdbRideStats(user.key),
+                             user.citibike_member_id)
         if user.is_logged_in_fitbit():
             cf.add_fitbit(user.fitbit_key, user.fitbit_secret)
-        if user.is_logged_in_google_fit():
+        if user.google_fit_credentials is not None:
             cf.add_google_fit(user.google_fit_credentials)
-        user.last_trip_id = cf.update(user.last_trip_id)
-        user.put()
+        user.last_trip_id = cf.update(user.last_trip_id, deadline,
+                                      user.sync_checkpoint)
+        user.sync_checkpoint = cf.checkpoint
+        user.citibike_member_id = cf.citibike.member_id
+        if cf.complete:
+            user.put()
+        return cf.complete
 
-        logging.debug("Releasing user update lock for user: %s" % userid)
-        lock = UserUpdateLock.query(ancestor=user.key).get()
-        lock.lock = False
-        lock.put()
+    @ndb.transactional
+    def _continue(self, user):
+        """
+        Saves the user progress and enqueues a task continuing its update. The
+        update lock is carried over to that task.
+        """
+        user.put()
+        taskqueue.add(url='/update', params={'userid': user.userid},
+                      transactional=True)
+        logging.debug("User update continuation enqueued for user: %s"
+                      % user.userid)
 
+    def _profiled_update(self, user, deadline):
+        """
+        Updates user under the profiler and stores the resulting profile, even
+        if the update fails. Clears the user profiling flag. Returns whether
+        the update completed.
+        """
+        logging.debug("Profiling update for user: %s" % user.userid)
+        profile = profiling.Profile()
+        try:
+            return profile.run(self._update, user, deadline)
+        finally:
+            UpdateProfile(parent=user.key,
+                          stats=profile.dump(),
+                          summary=profile.summary()).put()
+            if user.profile_next_update:
+                user.profile_next_update = False
+                user.put()
+
+    @staticmethod
     @ndb.transactional
-    def _enqueue(self, user):
+    def _enqueue(user):
         """
         Enqueues an update task for the user if the update lock for the user is
         free. Grabs the update lock.
         """
-        lock = UserUpdateLock.query(ancestor=user.key).get()
-        if not lock:
-            lock = UserUpdateLock(userid=user.userid, parent=user.key)
-        if lock.lock == False:
-            lock.lock = True
-            lock.put()
+        if Update._lock(user):
             taskqueue.add(url='/update', params={'userid': user.userid},
                           transactional=True)
             logging.debug("User update task enqueued for user: %s"
                           % user.userid)
-        else:
+
+    @staticmethod
+    @ndb.transactional
+    def _lock(user):
+        """
+        Grabs the update lock for the user if it is free. Returns whether it
+        was grabbed.
+        """
+        lock = UserUpdateLock.query(ancestor=user.key).get()
+        if not lock:
+            lock = UserUpdateLock(userid=user.userid, parent=user.key)
+        if lock.lock:
             logging.debug("User update is locked for user: %s" % user.userid)
+            return False
+        lock.lock = True
+        lock.put()
+        return True
+
+    @staticmethod
+    def _unlock(user):
+        """
+        Releases the update lock for the user.
+        """
+        logging.debug("Releasing user update lock for user: %s" % user.userid)
+        lock = UserUpdateLock.query(ancestor=user.key).get()
+        if lock:
+            lock.lock = False
+            lock.put()
+
+class Profiles(webapp2.RequestHandler):
+    """
+    Admin handler listing and serving update profiles.
+    """
+    def get(self):
+        """
+        Serves the raw pstats dump of the profile with key id, or its summary
+        if summary is set. Lists the profiles of user userid otherwise.
+        """
+        if self.request.get('id'):
+            profile = ndb.Key(urlsafe=self.request.get('id')).get()
+            if not profile:
+                self.abort(404)
+            if self.request.get('summary'):
+                self.response.content_type = 'text/plain'
+                self.response.write(profile.summary)
+            else:
+                self.response.content_type = 'application/octet-stream'
+                self.response.headers['Content-Disposition'] = (
+                    'attachment; filename="update-%s.pstats"'
+                    % profile.created.strftime('%Y%m%d%H%M%S'))
+                self.response.write(profile.stats)
+            return
+
+        userid = self.request.get('userid')
+        q = UpdateProfile.query(ancestor=ndb.Key(UserSettings, userid))
+        self.response.content_type = 'text/plain'
+        for profile in q.order(-UpdateProfile.created).fetch(20):
+            self.response.write('%s %s\n' % (profile.created,
+                                             profile.key.urlsafe()))
+
+    def post(self):
+        """
+        Flags the next update of user userid to be profiled and enqueues it,
+        unless an update of the user is already running.
+        """
+        user = UserSettings.get_by_userid(self.request.get('userid'))
+        if not user:
+            self.abort(404)
+        user.profile_next_update = True
+        user.put()
+        Update._enqueue(user)
+
+class RebuildStats(webapp2.RequestHandler):
+    """
+    Admin handler rebuilding ride statistics from the Citibike trip history
+    of each user. Meant to be run once for users whose trips were delivered
+    before statistics were kept, and to repair statistics if needed. Holds the
+    update lock of the user while rebuilding since it overwrites the
+    statistics.
+    """
+    def get(self):
+        """
+        Enqueues one rebuild task per user.
+        """
+        for key in UserSettings.query().fetch(keys_only=True):
+            taskqueue.add(url='/admin/rebuild-stats',
+                          params={'userid': key.id()})
+
+    def post(self):
+        """
+        Rebuilds the statistics of user userid from its Citibike history. Fails
+        while the user is being updated so the task is retried later.
+        """
+        user = UserSettings.get_by_userid(self.request.get('userid'))
+        if not user:
+            self.abort(404)
+        if not user.is_logged_in_citibike():
+            logging.debug("No Citibike account for user: %s" % user.userid)
+            return
+        if not Update._lock(user):
+            self.abort(409)
+
+        try:
+            cf = citifit.Citifit(user.citibike_username,
+                                 user.citibike_password,
+                                 ride_stats=NdbRideStats(user.key, load=False),
+                                 citibike_member_id=user.citibike_member_id)
+            counted = cf.rebuild_stats()
+        finally:
+            Update._unlock(user)
+        logging.debug("Rebuilt ride stats for user %s from %d trips"
+                      % (user.userid, counted))
 
 class Handler(webapp2.RequestHandler):
     """
@@ -136,10 +528,10 @@ class Handler(webapp2.RequestHandler):
 
     @webapp2.cached_property
     def settings(self):
-        q = UserSettings.query(UserSettings.userid == self.user.user_id())
-        settings = q.get()
+        userid = self.user.user_id()
+        settings = UserSettings.get_by_userid(userid)
         if not settings:
-            settings = UserSettings(userid=self.user.user_id())
+            settings = UserSettings(id=userid, userid=userid)
             settings.put()
         return settings
 
@@ -158,6 +550,7 @@ class Citibike(Handler):
     def post(self):
         self.settings.citibike_username = self.request.get('username')
         self.settings.citibike_password = self.request.get('password')
+        self.settings.citibike_member_id = None
         self.settings.put()
 
         self.redirect('/')
@@ -194,9 +587,11 @@ class GoogleFit(Handler):
     """
     Handler responsible for the management of Google Fit credentials.
     """
-    @oauth_decorator.oauth_required
     def get(self):
-        self.settings.google_fit_credentials = oauth_decorator.get_credentials()
+        oauth.decorator.oauth_required(GoogleFit._save_credentials)(self)
+
+    def _save_credentials(self):
+        self.settings.google_fit_credentials = oauth.decorator.get_credentials()
         self.settings.put()
 
         self.redirect('/')
@@ -205,19 +600,44 @@ class Main(Handler):
     """
     Main handler responsible for the main landing page.
     """
+    NUM_TOP_PAIRS = 3
+
     def get(self):
+        ride_stats = NdbRideStats(self.settings.key)
+        now = stats.RideStats.local_now()
         template = JINJA_ENVIRONMENT.get_template('index.html')
         self.response.write(template.render({
             'last_trip_id': self.settings.last_trip_id,
+            'totals': ride_stats.totals,
+            'this_week': ride_stats.week_bucket(now),
+            'this_month': ride_stats.month_bucket(now),
+            'top_pairs': ride_stats.top_pairs(Main.NUM_TOP_PAIRS),
             'has_citibike': self.settings.is_logged_in_citibike(),
             'has_fitbit': self.settings.is_logged_in_fitbit(),
             'has_google_fit': self.settings.is_logged_in_google_fit()
         }))
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-    extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+class Warmup(webapp2.RequestHandler):
+    """
+    Warmup handler called by App Engine when starting a new instance. Imports
+    the heavy modules and fills the caches shared by all users so the first
+    request or update task on the instance doesn't pay for them.
+    """
+    def get(self):
+        for name in ['base.html', 'citibike.html', 'index.html']:
+            JINJA_ENVIRONMENT.get_template(name)
+        try:
+            citibike.Citibike().stations()
+            caching_fetcher = fetcher.CachingFetcher(
+                fetcher.UrllibFetcher(),
+                persistent=fetcher.MemcacheResponseCache())
+            caching_fetcher.fetch(citifit.GoogleFitService.DISCOVERY_URL)
+            # Accessing an attribute imports the module.
+            fitbit.Fitbit
+        except:
+            logging.exception('Warmup failed: %s' % sys.exc_info()[0])
+
+JINJA_ENVIRONMENT = templates.environment()
 
 config = {}
 config['webapp2_extras.sessions'] = {
@@ -230,5 +650,9 @@ application = webapp2.WSGIApplication([
     ('/fitbit', Fitbit),
     ('/google-fit', GoogleFit),
     ('/update', Update),
-    (oauth_decorator.callback_path, oauth_decorator.callback_handler()),
+    ('/_ah/warmup', Warmup),
+    ('/admin/profiles', Profiles),
+    ('/admin/rebuild-stats', RebuildStats),
+    # Must match oauth.CALLBACK_PATH. The handler is imported on first use.
+    ('/oauth2callback', 'oauth.CallbackHandler'),
 ], debug=True, config=config)
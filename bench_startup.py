@@ -0,0 +1,37 @@
+"""
+Measures the import time of the application modules, each in a fresh
+interpreter as on a new instance. The App Engine SDK must be on PYTHONPATH to
+import app.
+
+  python bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+
+MODULES = ['app', 'citibike', 'citifit', 'fetcher', 'ledger', 'maps',
+           'templates']
+
+IMPORT_SCRIPT = ('import time; start = time.time(); import %s; ' +
+                 'print(time.time() - start)')
+
+def import_time(module, runs):
+    """
+    Returns the median import time of module in seconds over runs.
+    """
+    times = []
+    for run in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT % module],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(output.strip().splitlines()[-1]))
+    times.sort()
+    return times[len(times) // 2]
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in MODULES:
+        try:
+            print('%-10s %8.1f ms' % (module, import_time(module, runs) * 1000))
+        except subprocess.CalledProcessError:
+            print('%-10s   failed' % module)
@@ -0,0 +1,142 @@
+"""
+Compares the HTML and JSON trip sources on the same synthetic trip history
+served by a local stand-in server, reporting bytes transferred and the time
+taken to fetch and parse all trips.
+
+  python bench_trips.py [trips]
+"""
+import BaseHTTPServer
+import json
+import sys
+import threading
+import time
+import urlparse
+
+from datetime import datetime
+from pytz import timezone
+
+import citibike
+
+HTML_PAGE_SIZE = 10
+JSON_PAGE_SIZE = 50
+MEMBER_ID = 'bench'
+
+STATIONS = ['W 52 St & 11 Ave', 'Franklin St & W Broadway',
+            'St James Pl & Pearl St', 'Atlantic Ave & Fort Greene Pl']
+
+HTML_TRIP = '''
+<div class="ed-table__item ed-table__item_trip">
+  <div class="ed-table__col trip-start-date">%s</div>
+  <div class="ed-table__col trip-start-station">%s</div>
+  <div class="ed-table__col trip-end-date">%s</div>
+  <div class="ed-table__col trip-end-station">%s</div>
+  <div class="ed-table__col trip-duration">%d min %d s</div>
+</div>'''
+
+def history(num_trips):
+    """
+    Returns num_trips synthetic trips, newest first, as (start, end, start
+    station index, end station index) with times in seconds since the epoch.
+    """
+    newest = 1420070400
+    trips = []
+    for i in range(num_trips):
+        start = newest - i * 7200
+        trips.append((start, start + 600 + i % 300, i % len(STATIONS),
+                      (i + 1) % len(STATIONS)))
+    return trips
+
+def html_page(trips, page):
+    def date(t):
+        dt = datetime.fromtimestamp(t, timezone('US/Eastern'))
+        return dt.strftime('%m/%d/%Y %I:%M:%S %p')
+
+    last = (len(trips) - 1) // HTML_PAGE_SIZE
+    rows = []
+    for start, end, orig, dest in trips[page * HTML_PAGE_SIZE:
+                                        (page + 1) * HTML_PAGE_SIZE]:
+        rows.append(HTML_TRIP % (date(start), STATIONS[orig], date(end),
+                                 STATIONS[dest], (end - start) // 60,
+                                 (end - start) % 60))
+    return ('<html><body><div class="ed-table">%s</div>' +
+            '<a href="?pageNumber=%d">Oldest</a></body></html>') % (
+                ''.join(rows), last)
+
+def json_page(trips, cursor):
+    page = trips[cursor:cursor + JSON_PAGE_SIZE]
+    next_cursor = cursor + JSON_PAGE_SIZE
+    return json.dumps({
+        'trips': [{
+            'start_station_id': orig,
+            'start_time': start,
+            'end_station_id': dest,
+            'end_time': end,
+            'duration': end - start,
+        } for start, end, orig, dest in page],
+        'next_cursor': str(next_cursor) if next_cursor < len(trips) else None,
+    })
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the member trip pages under /trips/ and the JSON trip history under
+    /api/trips, counting the bytes served for each.
+    """
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path.startswith('/trips/'):
+            kind = 'html'
+            page = int(params.get('pageNumber', ['0'])[0])
+            body = html_page(self.server.trips, page)
+        else:
+            kind = 'json'
+            cursor = int(params.get('cursor', ['0'])[0])
+            body = json_page(self.server.trips, cursor)
+        self.server.bytes[kind] += len(body)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def html_trips(source, station_ids):
+    html, elems = source._page_elements(MEMBER_ID, 0)
+    last = source._last_trip_page_number(MEMBER_ID, html)
+    trips = []
+    for page in range(last + 1):
+        if page > 0:
+            _, elems = source._page_elements(MEMBER_ID, page)
+        trips.extend(source._parse_trips(elems, station_ids)[0])
+    return trips
+
+if __name__ == '__main__':
+    num_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.trips = history(num_trips)
+    server.bytes = {'html': 0, 'json': 0}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+
+    cb = citibike.Citibike()
+    station_ids = {name: id for id, name in enumerate(STATIONS)}
+
+    start = time.time()
+    html = html_trips(citibike.HtmlTripSource(cb, base + '/trips/'),
+                      station_ids)
+    html_time = time.time() - start
+
+    start = time.time()
+    source = citibike.JsonTripSource(cb, base + '/api/trips')
+    trips, _ = source.trips(-1, lambda refresh=False: station_ids)
+    json_time = time.time() - start
+
+    print('%d trips' % num_trips)
+    print('html  %6d trips %9d bytes %8.1f ms'
+          % (len(html), server.bytes['html'], html_time * 1000))
+    print('json  %6d trips %9d bytes %8.1f ms'
+          % (len(trips), server.bytes['json'], json_time * 1000))
+    server.shutdown()
@@ -1,11 +1,8 @@
-import Cookie
-import cookielib
 import json
 import logging
 import re
 import time
 import urllib
-import urllib2
 
 from datetime import datetime
 from lxml import etree
@@ -13,6 +10,8 @@ from pytz import timezone
 
 from excepts import BadResponse
 from excepts import LogoutException
+from fetcher import CachingFetcher
+from fetcher import UrllibFetcher
 
 class Citibike:
     """
@@ -27,60 +26,106 @@ class Citibike:
 
     TRIP_URL = 'https://member.citibikenyc.com/profile/trips/'
 
-    STATION_URL = 'http://www.citibikenyc.com/stations/json'
-
     NUM_RETRY = 5
 
-    def __init__(self, username=None, password=None):
+    # Pages specific to the logged in user, never cached.
+    MEMBER_URL = 'https://member.citibikenyc.com/'
+
+    def __init__(self, username=None, password=None, station_sources=None,
+                 trips_api_url=None, member_id=None):
+        """
+        Initializes the wrapper and logs in if credentials are provided.
+        Stations are read from the first of station_sources that succeeds,
+        the GBFS feed then the legacy station feed if not provided. Trips are
+        read from the JSON trip history at trips_api_url if provided, and
+        scraped from the member site otherwise. member_id, as resolved by a
+        previous wrapper, saves fetching the profile page to resolve it.
+        """
         self.username = username
         self.password = password
-        self.fetcher = UrllibFetcher()
+        self.member_id = member_id
+        bypass_prefixes = [Citibike.MEMBER_URL]
+        if trips_api_url:
+            bypass_prefixes.append(trips_api_url)
+        self.fetcher = CachingFetcher(UrllibFetcher(),
+                                      bypass_prefixes=bypass_prefixes)
+        self.station_sources = station_sources or [
+            GbfsStationSource(self.fetcher),
+            BeanListStationSource(self.fetcher),
+        ]
+        if trips_api_url:
+            self.trip_source = JsonTripSource(self, trips_api_url)
+        else:
+            self.trip_source = HtmlTripSource(self)
 
         if self.username != None and self.password != None:
             self._login(self.username, self.password)
 
-    def trips(self, min_id=-1):
+    def trips(self, min_id=-1, failures=None):
+        """
+        Fetches all the trips for the logged in user with an id greater than
+        min_id from the trip source. If failures is a list, trips that can't be
+        parsed are appended to it as (trip id, reason) instead of failing the
+        whole fetch.
         """
-        Fetches all the trips for the logged in user.
+        return self.resume_trips(min_id, failures=failures)[0]
+
+    def resume_trips(self, min_id=-1, cursor=None, deadline=None,
+                     failures=None):
+        """
+        Fetches the trips for the logged in user with an id greater than min_id,
+        resuming from cursor if provided. Stops between pages once the deadline
+        timestamp is passed. Returns the trips and the cursor to resume from,
+        None if all trips were fetched.
         """
         if self.username == None or self.password == None:
             raise LogoutException()
 
-        station_ids = {s.name: s.id for s in self.stations()}
-        if len(station_ids) == 0:
-            raise BadResponse('Trips Request Failed',
-                              'Could not fetch stations.')
-
-        member_id = self._member_id()
-        last = self._last_trip_page_number(member_id)
-        trips = []
-        for page in range(last + 1):
-            page_trips = self._page_trips(member_id, page, station_ids)
-            for trip in page_trips:
-                if trip.id <= min_id:
-                    logging.debug("Retrieved %d trips" % len(trips))
-                    return trips
-                trips.append(trip)
+        trips, cursor = self.trip_source.trips(min_id, self._station_ids,
+                                               failures, cursor, deadline)
         logging.debug("Retrieved %d trips" % len(trips))
-        return trips
+        return trips, cursor
 
-    def stations(self):
+    def stations(self, status=False, refresh=False):
         """
-        Fetches all the stations and their status as of the time of the request.
+        Fetches all the stations. Their live status as of the time of the
+        request is only fetched if status is set, otherwise available bikes and
+        docks may be None. Cached station information is dropped first if
+        refresh is set, e.g. when a station can't be found in it.
         """
-        stations = []
-        f = self._fetch(Citibike.STATION_URL)
-        data = json.load(f)
-        if 'stationBeanList' not in data or len(data['stationBeanList']) == 0:
-            raise BadResponse('Station Fetch Failed', data)
-        for station in data['stationBeanList']:
-            stations.append(Station._from_json(station))
-        logging.debug("Retrieved %d stations" % len(stations))
-        return stations
+        for source in self.station_sources:
+            try:
+                if refresh:
+                    source.refresh()
+                stations = source.stations()
+                if status:
+                    stations = source.status(stations)
+            except:
+                logging.exception("Station source failed: %s"
+                                  % source.__class__.__name__)
+                continue
+            logging.debug("Retrieved %d stations" % len(stations))
+            return stations
+        raise BadResponse('Station Fetch Failed',
+                          'Could not fetch stations from any source.')
 
     def _fetch(self, uri, data={}):
         return self.fetcher.fetch(uri, data)
 
+    def _relogin(self):
+        self._login(self.username, self.password)
+
+    def _station_ids(self, refresh=False):
+        """
+        Returns station ids by station name, refreshing the stations first if
+        refresh is set.
+        """
+        station_ids = {s.name: s.id for s in self.stations(refresh=refresh)}
+        if len(station_ids) == 0:
+            raise BadResponse('Trips Request Failed',
+                              'Could not fetch stations.')
+        return station_ids
+
     def _login(self, username, password):
         for retry in range(Citibike.NUM_RETRY):
             token = self._token()
@@ -116,7 +161,17 @@ class Citibike:
                 return token
         raise BadResponse('Token Request Failed', 'Could not fetch token.')
 
-    def _member_id(self):
+    def _member_id(self, refresh=False):
+        """
+        Returns the member id of the logged in user, only resolving it from
+        the profile page if unknown or if refresh is set.
+        """
+        if self.member_id is not None and not refresh:
+            return self.member_id
+        self.member_id = self._fetch_member_id()
+        return self.member_id
+
+    def _fetch_member_id(self):
         MEMBER_ID_XPATH = '//a[contains(@href, "memberId")]/@href'
         MEMBER_ID_REGEXP = r'memberId=([^&]+)'
         for retry in range(Citibike.NUM_RETRY):
@@ -138,38 +193,163 @@ class Citibike:
         raise BadResponse('Member Id Request Failed',
                           'Could not fetch member id.')
 
-    def _last_trip_page_number(self, member_id):
-        LAST_TRIP_PAGE_XPATH = '//a[text()="Oldest"]/@href'
-        LAST_TRIP_PAGE_REGEXP = r'pageNumber=([\d]+)'
-        trip_url = Citibike.TRIP_URL + member_id
+class TripSource:
+    """
+    TripSource provides an interface to fetch the trips of the member logged in
+    a Citibike wrapper.
+    """
+    def trips(self, min_id, station_ids, failures=None, cursor=None,
+              deadline=None):
+        """
+        Returns the trips with an id greater than min_id, newest first, and the
+        cursor to resume from if the deadline timestamp was passed before all
+        were fetched, None otherwise. Fetching starts from cursor if provided.
+        station_ids is a function returning station ids by name, only called
+        if needed, with refresh set to refresh the stations. Trips with a
+        station that can't be found are appended to failures as (trip id,
+        reason) if it is a list, and raise otherwise. Pages that can't be
+        parsed raise BadResponse.
+        """
+        raise NotImplementedError("Subclass need implement trips.")
+
+    def _is_past(self, deadline):
+        return deadline != None and time.time() > deadline
+
+class StationIds:
+    """
+    Station ids by name, loaded with the load function on first lookup. A name
+    missing from the stations refreshes them once, in case the station opened
+    since they were cached, before the lookup fails.
+    """
+    def __init__(self, load):
+        self.load = load
+        self._ids = None
+        self._refreshed = False
+
+    def __getitem__(self, name):
+        if self._ids is None:
+            self._ids = self.load()
+        if name not in self._ids and not self._refreshed:
+            logging.debug("Refreshing stations for unknown station: %s" % name)
+            self._ids = self.load(refresh=True)
+            self._refreshed = True
+        return self._ids[name]
+
+class HtmlTripSource(TripSource):
+    """
+    Trips scraped from the trip pages of the member site, newest first. Only
+    the newest trip page is fetched if it has no new trip, in which case
+    stations and older pages aren't loaded at all. The member id known to the
+    wrapper is trusted and only resolved again if its trip pages can't be
+    fetched. Cursors are page numbers.
+    Since new trips push older ones to later pages, fetching resumes from the
+    page before the cursor.
+    """
+    def __init__(self, citibike, trip_url=None):
+        self.citibike = citibike
+        self.trip_url = trip_url or Citibike.TRIP_URL
+
+    def trips(self, min_id, station_ids, failures=None, cursor=None,
+              deadline=None):
+        if cursor is None:
+            member_id, html, elems = self._first_page_elements(0)
+            newest_id = Trip._newest_completed_id(elems)
+            if newest_id == None or newest_id <= min_id:
+                logging.debug("No new trips since trip: %d" % min_id)
+                return [], None
+
+            station_ids = StationIds(station_ids)
+            trips, done = self._parse_trips(elems, station_ids, min_id,
+                                            failures)
+            first = 1
+        else:
+            first = max(int(cursor) - 1, 0)
+            member_id, html, elems = self._first_page_elements(first)
+            station_ids = StationIds(station_ids)
+            trips, done = self._parse_trips(elems, station_ids, min_id,
+                                            failures)
+            first += 1
+
+        if not done:
+            last = self._last_trip_page_number(member_id, html)
+            for page in range(first, last + 1):
+                if len(trips) > 0 and self._is_past(deadline):
+                    logging.debug("Deadline passed before page: %d" % page)
+                    return trips, str(page)
+                _, elems = self._page_elements(member_id, page)
+                page_trips, done = self._parse_trips(elems, station_ids,
+                                                     min_id, failures)
+                trips.extend(page_trips)
+                if done:
+                    break
+        return trips, None
+
+    def _first_page_elements(self, page):
+        """
+        Fetches the first trip page of a fetch. Returns the member id along
+        with the parsed page and its trip elements. Resolves the member id
+        again if the known one fails, e.g. because it is stale.
+        """
+        member_id = self.citibike._member_id()
+        try:
+            return (member_id,) + self._page_elements(member_id, page)
+        except BadResponse:
+            logging.warning("Failed to fetch trips for member id: %s"
+                            % member_id)
+            fresh_id = self.citibike._member_id(refresh=True)
+            if fresh_id == member_id:
+                raise
+            return (fresh_id,) + self._page_elements(fresh_id, page)
+
+    def _last_trip_page_number(self, member_id, html=None):
+        """
+        Returns the number of the oldest trip page. Reads it from html, a trip
+        page already fetched, when it has the link to that page.
+        """
+        trip_url = self.trip_url + member_id
+        if html is not None:
+            page_number = self._parse_last_trip_page_number(html)
+            if page_number is not None:
+                return page_number
         for retry in range(Citibike.NUM_RETRY):
-            f = self._fetch(trip_url)
+            f = self.citibike._fetch(trip_url)
             if f.geturl() == Citibike.LOGIN_URL:
-                self._login(self.username, self.password)
+                self.citibike._relogin()
                 continue
             if f.geturl() != trip_url:
                 time.sleep(2**retry)
                 continue
             html = etree.parse(f, etree.HTMLParser())
-            href = html.xpath(LAST_TRIP_PAGE_XPATH)
-            member_id = None
-            if len(href) > 0:
-                match = re.search(LAST_TRIP_PAGE_REGEXP, href[0])
-                if match:
-                    page_number = int(match.group(1))
-                    logging.debug("Retrieved last trip page number: %d"
-                                  % page_number)
-                    return page_number
+            page_number = self._parse_last_trip_page_number(html)
+            if page_number is not None:
+                return page_number
         raise BadResponse('Last Trip Page Number Request Failed',
                           'Could not fetch last trip page for %s.' % member_id)
 
-    def _page_trips(self, member_id, page, station_ids):
+    def _parse_last_trip_page_number(self, html):
+        LAST_TRIP_PAGE_XPATH = '//a[text()="Oldest"]/@href'
+        LAST_TRIP_PAGE_REGEXP = r'pageNumber=([\d]+)'
+        href = html.xpath(LAST_TRIP_PAGE_XPATH)
+        if len(href) > 0:
+            match = re.search(LAST_TRIP_PAGE_REGEXP, href[0])
+            if match:
+                page_number = int(match.group(1))
+                logging.debug("Retrieved last trip page number: %d"
+                              % page_number)
+                return page_number
+        return None
+
+    def _page_elements(self, member_id, page):
+        """
+        Fetches a trip page. Returns the parsed page and its trip elements,
+        newest first.
+        """
         TRIP_XPATH = '//div[contains(@class, "ed-table__item_trip")]'
-        trip_url = Citibike.TRIP_URL + member_id + '?pageNumber=' + str(page)
+        trip_url = self.trip_url + member_id + '?pageNumber=' + str(page)
         for retry in range(Citibike.NUM_RETRY):
-            f = self._fetch(trip_url)
+            f = self.citibike._fetch(trip_url)
             if f.geturl() == Citibike.LOGIN_URL:
-                self._login(self.username, self.password)
+                self.citibike._relogin()
                 continue
             if f.geturl() != trip_url:
                 time.sleep(2**retry)
@@ -177,14 +357,168 @@ class Citibike:
             html = etree.parse(f, etree.HTMLParser())
             elems = html.xpath(TRIP_XPATH)
             if (len(elems) > 0):
-                trips = filter(None, [Trip._from_element(e, station_ids)
-                                      for e in elems])
-                logging.debug("Retrieved %d trips from page: %d"
-                              % (len(trips), page))
-                return trips
+                logging.debug("Retrieved %d trip elements from page: %d"
+                              % (len(elems), page))
+                return html, elems
         raise BadResponse('Page Trips Request Failed',
                           'Could not fetch trips for page %d.' % page)
 
+    # Errors raised parsing a trip element whose layout is not as expected.
+    PARSE_ERRORS = (AttributeError, IndexError, TypeError, ValueError)
+
+    def _parse_trips(self, elems, station_ids, min_id=-1, failures=None):
+        """
+        Parses trip elements, newest first. Stops parsing at the first trip
+        with an id lower or equal to min_id. Returns the trips and whether such
+        a trip was found. Appends trips with an unknown station, and trips that
+        can't be parsed while others of the page can, to failures if provided.
+        Raises BadResponse otherwise if a trip can't be parsed, e.g. because
+        the page layout changed, so it is fetched again on the next update.
+        """
+        trips = []
+        bad = []
+        parsed = False
+        done = False
+        for e in elems:
+            try:
+                id = Trip._id_from_element(e)
+            except HtmlTripSource.PARSE_ERRORS as ex:
+                bad.append((None, ex))
+                continue
+            if id <= min_id:
+                if bad and not parsed:
+                    parsed = self._is_parsable(e, station_ids)
+                done = True
+                break
+            try:
+                trip = Trip._from_element(e, station_ids)
+            except KeyError as ex:
+                if failures is None:
+                    raise
+                logging.warning("Unknown station for trip %d: %r" % (id, ex))
+                failures.append((id, 'Unknown station: %r' % ex))
+                parsed = True
+                continue
+            except HtmlTripSource.PARSE_ERRORS as ex:
+                bad.append((id, ex))
+                continue
+            parsed = True
+            if trip is not None:
+                trips.append(trip)
+
+        if bad and (failures is None or not parsed):
+            id, ex = bad[0]
+            raise BadResponse('Trip Parse Failed',
+                              'Could not parse trip %s: %r' % (id, ex))
+        for id, ex in bad:
+            if id is None:
+                # Can't be recorded, nor compared to min_id.
+                logging.warning("Skipping trip without start time: %r" % ex)
+                continue
+            logging.warning("Failed to parse trip %d: %r" % (id, ex))
+            failures.append((id, 'Parse failed: %r' % ex))
+        return trips, done
+
+    def _is_parsable(self, e, station_ids):
+        """
+        Returns whether trip element e has the expected layout, stations aside.
+        """
+        try:
+            Trip._from_element(e, station_ids)
+        except KeyError:
+            pass
+        except HtmlTripSource.PARSE_ERRORS:
+            return False
+        return True
+
+class JsonTripSource(TripSource):
+    """
+    Trips read from a JSON trip history endpoint authenticated by the member
+    session, as used by the mobile app. Each page is a document of the form
+
+      {"trips": [{"start_station_id": 72, "start_time": 1420070400,
+                  "end_station_id": 79, "end_time": 1420071000,
+                  "duration": 600}, ...],
+       "next_cursor": "..."}
+
+    with trips newest first, times in seconds since the epoch, an end_time of
+    null for trips in progress and a next_cursor of null on the last page. The
+    next page is requested with the cursor query parameter, which is also the
+    cursor to resume from. Station ids are included so stations are never
+    loaded.
+    """
+    def __init__(self, citibike, url):
+        self.citibike = citibike
+        self.url = url
+
+    def trips(self, min_id, station_ids, failures=None, cursor=None,
+              deadline=None):
+        trips = []
+        while True:
+            if len(trips) > 0 and self._is_past(deadline):
+                logging.debug("Deadline passed before cursor: %s" % cursor)
+                return trips, cursor
+            page = self._page(cursor)
+            for t in page['trips']:
+                try:
+                    trip = Trip._from_json(t)
+                except (KeyError, TypeError, ValueError) as ex:
+                    if failures is None:
+                        raise
+                    id = self._trip_id(t)
+                    if id is None:
+                        # Can't be recorded, nor compared to min_id.
+                        logging.warning("Skipping trip without start time: %r"
+                                        % (t,))
+                        continue
+                    if id <= min_id:
+                        return trips, None
+                    logging.warning("Failed to parse trip %d: %r" % (id, ex))
+                    failures.append((id, 'Parse failed: %r' % ex))
+                    continue
+                if trip is None:
+                    continue
+                if trip.id <= min_id:
+                    return trips, None
+                trips.append(trip)
+            cursor = page.get('next_cursor')
+            if not cursor:
+                return trips, None
+
+    def _trip_id(self, t):
+        """
+        Returns the id of trip document t, or None if it has no valid start
+        time.
+        """
+        try:
+            return int(t['start_time'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _page(self, cursor=None):
+        url = self.url
+        if cursor:
+            url += ('&' if '?' in url else '?') + urllib.urlencode({
+                'cursor': cursor,
+            })
+        for retry in range(Citibike.NUM_RETRY):
+            f = self.citibike._fetch(url)
+            if f.geturl() == Citibike.LOGIN_URL:
+                self.citibike._relogin()
+                continue
+            try:
+                page = json.load(f)
+            except ValueError:
+                time.sleep(2**retry)
+                continue
+            if 'trips' in page:
+                logging.debug("Retrieved %d trips from cursor: %s"
+                              % (len(page['trips']), cursor))
+                return page
+            time.sleep(2**retry)
+        raise BadResponse('Trip History Request Failed',
+                          'Could not fetch trips for cursor %s.' % cursor)
+
 class Trip:
     """
     User trip from one station to another.
@@ -198,21 +532,47 @@ class Trip:
         self.end_time = end_time
         self.duration = duration
 
+    START_TIME_XPATH = './/div[contains(@class, "trip-start-date")]/text()'
+    DURATION_XPATH = './/div[contains(@class, "trip-duration")]/text()'
+
+    @staticmethod
+    def _newest_completed_id(elems):
+        """
+        Returns the id of the first completed trip of elements, newest first,
+        or None if there is none. Trips in progress have no duration yet.
+        """
+        for e in elems:
+            if e.xpath(Trip.DURATION_XPATH)[0].strip() != '-':
+                return Trip._id_from_element(e)
+        return None
+
+    @staticmethod
+    def _id_from_element(e):
+        """
+        Extracts only the trip id, derived from its start time, from an element.
+        """
+        start_time = Trip._parse_date(e.xpath(Trip.START_TIME_XPATH)[0].strip())
+        return Trip._id_from_start_time(start_time)
+
+    @staticmethod
+    def _id_from_start_time(start_time):
+        epoch = datetime(1970, 1, 1, tzinfo=timezone('UTC'))
+        return int((start_time - epoch).total_seconds())
+
+    @staticmethod
+    def _parse_date(s):
+        TIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+        dt = datetime.strptime(s, TIME_FORMAT)
+        dt = timezone('US/Eastern').localize(dt)
+        return dt
+
     @staticmethod
     def _from_element(e, station_ids):
         START_STATION_XPATH = ('.//div[contains(@class, ' +
                                '"trip-start-station")]/text()')
         END_STATION_XPATH = ('.//div[contains(@class, ' +
                              '"trip-end-station")]/text()')
-        START_TIME_XPATH = './/div[contains(@class, "trip-start-date")]/text()'
         END_TIME_XPATH = './/div[contains(@class, "trip-end-date")]/text()'
-        DURATION_XPATH = './/div[contains(@class, "trip-duration")]/text()'
-
-        def parse_date(s):
-            TIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
-            dt = datetime.strptime(s, TIME_FORMAT)
-            dt = timezone('US/Eastern').localize(dt)
-            return dt
 
         def parse_duration(s):
             DURATION_REGEXP = r'(?:(\d+) h )?(\d+) min (\d+) s'
@@ -222,22 +582,40 @@ class Trip:
             secs = int(match.group(3))
             return hours * 3600 + mins * 60 + secs
 
-        def timestamp_utc(dt):
-            epoch = datetime(1970, 1, 1, tzinfo=timezone('UTC'))
-            return (dt - epoch).total_seconds()
-
-        duration_text = e.xpath(DURATION_XPATH)[0].strip()
+        duration_text = e.xpath(Trip.DURATION_XPATH)[0].strip()
         if (duration_text == '-'):
             return None
         duration = parse_duration(duration_text)
 
         start_station = station_ids[e.xpath(START_STATION_XPATH)[0].strip()]
-        start_time = parse_date(e.xpath(START_TIME_XPATH)[0].strip())
+        start_time = Trip._parse_date(e.xpath(Trip.START_TIME_XPATH)[0].strip())
 
         end_station = station_ids[e.xpath(END_STATION_XPATH)[0].strip()]
-        end_time = parse_date(e.xpath(END_TIME_XPATH)[0].strip())
+        end_time = Trip._parse_date(e.xpath(END_TIME_XPATH)[0].strip())
+
+        id = Trip._id_from_start_time(start_time)
+
+        return Trip(id, start_station, start_time, end_station, end_time,
+                    duration)
+
+    @staticmethod
+    def _from_json(j):
+        def parse_timestamp(t):
+            dt = datetime.fromtimestamp(int(t), timezone('UTC'))
+            return dt.astimezone(timezone('US/Eastern'))
+
+        if j.get('end_time') is None:
+            return None
+
+        start_station = int(j['start_station_id'])
+        start_time = parse_timestamp(j['start_time'])
+
+        end_station = int(j['end_station_id'])
+        end_time = parse_timestamp(j['end_time'])
 
-        id = int(timestamp_utc(start_time))
+        duration = int(j['duration'])
+
+        id = Trip._id_from_start_time(start_time)
 
         return Trip(id, start_station, start_time, end_station, end_time,
                     duration)
@@ -269,23 +647,141 @@ class Station:
         return Station(id, name, lat, lng, total_docks, available_bikes,
                        available_docks)
 
-class Fetcher:
-    def fetch(self, uri, data={}):
-        raise NotImplementedError("Subclass need implement fetch.")
+    @staticmethod
+    def _from_gbfs(j):
+        id = Station._gbfs_id(j)
+        name = j['name']
+        lat = float(j['lat'])
+        lng = float(j['lon'])
+        total_docks = j.get('capacity')
 
-class UrllibFetcher(Fetcher):
-    def __init__(self):
-        self.cookies = cookielib.LWPCookieJar()
-        handlers = [
-            urllib2.HTTPCookieProcessor(self.cookies),
-        ]
-        self.opener = urllib2.build_opener(*handlers)
+        return Station(id, name, lat, lng, total_docks, None, None)
 
-    def fetch(self, uri, data={}):
-        logging.debug('Fetching %s', uri)
-        if (len(data) > 0):
-            data = urllib.urlencode(data)
-            req = urllib2.Request(uri, data)
-        else:
-            req = urllib2.Request(uri)
-        return self.opener.open(req)
+    @staticmethod
+    def _gbfs_id(j):
+        """
+        Returns the integer id of a GBFS station document. GBFS station ids are
+        strings, so feeds with non integer ids are read by their legacy_id.
+        Raises KeyError, TypeError or ValueError if the station has no integer
+        id.
+        """
+        try:
+            return int(j['station_id'])
+        except ValueError:
+            return int(j['legacy_id'])
+
+class StationSource:
+    """
+    StationSource provides an interface to fetch the static station information
+    and, separately, their live status.
+    """
+    def stations(self):
+        """
+        Returns all the stations. Available bikes and docks may be None.
+        """
+        raise NotImplementedError("Subclass need implement stations.")
+
+    def status(self, stations):
+        """
+        Returns copies of stations updated with their live status.
+        """
+        raise NotImplementedError("Subclass need implement status.")
+
+    def refresh(self):
+        """
+        Drops cached station information so the next call to stations fetches
+        it again. Nothing to do for sources that don't cache it.
+        """
+        pass
+
+class BeanListStationSource(StationSource):
+    """
+    Legacy station feed listing the information and status of all stations in
+    a single stationBeanList document.
+    """
+    STATION_URL = 'http://www.citibikenyc.com/stations/json'
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    def stations(self):
+        f = self.fetcher.fetch(BeanListStationSource.STATION_URL)
+        data = json.load(f)
+        if 'stationBeanList' not in data or len(data['stationBeanList']) == 0:
+            raise BadResponse('Station Fetch Failed', data)
+        return [Station._from_json(s) for s in data['stationBeanList']]
+
+    def status(self, stations):
+        # The feed always includes the status of every station.
+        return self.stations()
+
+class GbfsStationSource(StationSource):
+    """
+    General Bikeshare Feed Specification station feeds. Station information is
+    cached for all instances until its last_updated + ttl, and at least
+    INFO_MIN_TTL seconds since it rarely changes, or until refresh is called.
+    Station status is fetched on every call to status. Stations without an
+    integer id are skipped.
+    """
+    INFO_URL = 'https://gbfs.citibikenyc.com/gbfs/en/station_information.json'
+
+    STATUS_URL = 'https://gbfs.citibikenyc.com/gbfs/en/station_status.json'
+
+    INFO_MIN_TTL = 24 * 3600
+
+    # Maps info url to (expiry timestamp, stations).
+    _info_cache = {}
+
+    def __init__(self, fetcher, info_url=None, status_url=None):
+        self.fetcher = fetcher
+        self.info_url = info_url or GbfsStationSource.INFO_URL
+        self.status_url = status_url or GbfsStationSource.STATUS_URL
+
+    def stations(self):
+        now = time.time()
+        cached = GbfsStationSource._info_cache.get(self.info_url)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        data = self._fetch_feed(self.info_url)
+        stations = []
+        for s in data['data']['stations']:
+            try:
+                stations.append(Station._from_gbfs(s))
+            except (KeyError, TypeError, ValueError) as ex:
+                logging.warning("Skipping station %r: %r"
+                                % (s.get('station_id'), ex))
+        if len(stations) == 0:
+            raise BadResponse('Station Feed Fetch Failed', self.info_url)
+        expiry = max(data['last_updated'] + data['ttl'],
+                     now + GbfsStationSource.INFO_MIN_TTL)
+        GbfsStationSource._info_cache[self.info_url] = (expiry, stations)
+        logging.debug("Cached station information until %d" % expiry)
+        return stations
+
+    def refresh(self):
+        GbfsStationSource._info_cache.pop(self.info_url, None)
+
+    def status(self, stations):
+        data = self._fetch_feed(self.status_url)
+        status = {}
+        for s in data['data']['stations']:
+            try:
+                status[Station._gbfs_id(s)] = s
+            except (KeyError, TypeError, ValueError):
+                continue
+        updated = []
+        for station in stations:
+            s = status.get(station.id, {})
+            updated.append(Station(station.id, station.name, station.lat,
+                                   station.lng, station.total_docks,
+                                   s.get('num_bikes_available'),
+                                   s.get('num_docks_available')))
+        return updated
+
+    def _fetch_feed(self, url):
+        data = json.load(self.fetcher.fetch(url))
+        if ('data' not in data or 'stations' not in data['data'] or
+            len(data['data']['stations']) == 0):
+            raise BadResponse('Station Feed Fetch Failed', url)
+        return data
@@ -3,19 +3,34 @@ import sys
 sys.path.append("./lib/python2.7/site-packages/")
 
 import fitbit
+import httplib
 import httplib2
 import logging
 import time
 
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
 from datetime import datetime
+from fitbit.exceptions import HTTPBadRequest
+from fitbit.exceptions import HTTPConflict
+from fitbit.exceptions import HTTPForbidden
+from fitbit.exceptions import HTTPNotFound
+from fitbit.exceptions import HTTPServerError
+from fitbit.exceptions import HTTPTooManyRequests
+from fitbit.exceptions import HTTPUnauthorized
+from oauth2client.client import AccessTokenRefreshError
 from pytz import timezone
 
 import citibike
 import conf
+import ledger
 import maps
+import stats
 
 from excepts import BadResponse
+from fetcher import CachingFetcher
+from fetcher import MemcacheResponseCache
+from fetcher import UrllibFetcher
 
 class Citifit:
     """
@@ -24,22 +39,51 @@ class Citifit:
     """
     MIN_TRIP_DURATION = 60
 
-    def __init__(self, citibike_username, citibike_password):
+    # Transient delivery failures are retried after RETRY_DELAY seconds,
+    # doubled on every attempt, and parked after MAX_ATTEMPTS.
+    RETRY_DELAY = 3600
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, citibike_username, citibike_password, trip_ledger=None,
+                 ride_stats=None, citibike_member_id=None):
         """
         Initializes the different services required to perform update operation.
-        Connects to Citibike.
+        Connects to Citibike, as the member citibike_member_id if known. Trips
+        and their delivery state are recorded in trip_ledger, and trips are
+        counted in ride_stats when first delivered, both kept in memory if not
+        provided. Stations and services are only loaded once there are trips
+        to add.
         """
-        self.citibike = citibike.Citibike(citibike_username, citibike_password)
-        self.maps = maps.Maps(conf.GOOGLE_API_KEY)
+        self.fetcher = CachingFetcher(UrllibFetcher(),
+                                      persistent=MemcacheResponseCache())
+        self.citibike = citibike.Citibike(
+            citibike_username, citibike_password,
+            trips_api_url=conf.CITIBIKE_TRIPS_API_URL or None,
+            member_id=citibike_member_id)
+        self.maps = maps.Maps(conf.GOOGLE_API_KEY, self.fetcher)
+        self.ledger = trip_ledger or ledger.MemoryTripLedger()
+        self.ride_stats = ride_stats or stats.RideStats()
         self.services = []
-        self.stations = self._get_stations()
+        self._stations = None
+        self.checkpoint = None
+        self.complete = True
+
+    @property
+    def stations(self):
+        """
+        Stations by id, fetched on first use.
+        """
+        if self._stations is None:
+            self._stations = self._get_stations()
+        return self._stations
 
     def add_google_fit(self, google_fit_credentials):
         """
         Adds Google Fit service.
         """
         self.services.append(GoogleFitService(google_fit_credentials,
-                                              self.stations))
+                                              lambda: self.stations,
+                                              self.fetcher))
 
     def add_fitbit(self, fitbit_key, fitbit_secret):
         """
@@ -47,59 +91,220 @@ class Citifit:
         """
         self.services.append(FitbitService(fitbit_key, fitbit_secret))
 
-    def update(self, last_trip_id=0):
+    def update(self, last_trip_id=0, deadline=None, checkpoint=None):
         """
         Updates linked services with all Citibike trip after last_trip_id.
-        Returns the id of the last Citibike trip successfully added.
+        New trips are recorded in the ledger and each service is only sent the
+        trips it has not acknowledged yet. Trips failing permanently are parked
+        in the ledger dead letters and skipped, those failing transiently are
+        retried on later updates. Returns the id of the last Citibike trip done
+        with for all services. Trips failing to be fetched are fetched again on
+        the next update.
+
+        Work stops once the deadline timestamp is passed, leaving complete
+        False. Trips already fetched are recorded and, if older ones remain,
+        checkpoint is set to the position to resume fetching from. It must be
+        passed to the next update, which delivers trips once all are fetched.
         """
+        self.checkpoint = None
+        self.complete = True
         if len(self.services) == 0:
             logging.debug('No services to update')
+            # Trips older than the recorded ones remain to be fetched.
+            self.checkpoint = checkpoint
             return last_trip_id
 
-        for trip in self._get_trips(last_trip_id):
-            try:
-                logging.debug('Adding trip: %d' % trip.id)
-                self._add_trip(trip)
-            except:
-                logging.exception('Failed to add trip: %s' % sys.exc_info()[0])
-                logging.debug('Last trip id: %d' % last_trip_id)
+        if checkpoint:
+            min_id = checkpoint['min_id']
+            cursor = checkpoint['cursor']
+            logging.debug('Resuming from checkpoint: %s' % checkpoint)
+        else:
+            min_id = max(last_trip_id, self.ledger.last_trip_id())
+            cursor = None
+        failures = []
+        try:
+            trips, next_cursor = self._get_trips(min_id, failures, cursor,
+                                                 deadline)
+        except:
+            logging.exception('Failed to fetch trips: %s' % sys.exc_info()[0])
+            if checkpoint:
+                # Fetching resumes from the checkpoint on the next update.
+                self.checkpoint = checkpoint
                 return last_trip_id
-            last_trip_id = trip.id
-            time.sleep(1)
+            # Trips already recorded are still delivered.
+            failures = []
+            trips, next_cursor = [], None
+        if not self._record_trips(trips, failures):
+            # Trips older than the recorded ones must be fetched again.
+            if cursor is not None:
+                self.checkpoint = {'min_id': min_id, 'cursor': cursor}
+            return last_trip_id
+        if next_cursor is not None:
+            self.checkpoint = {'min_id': min_id, 'cursor': next_cursor}
+            self.complete = False
+            return last_trip_id
+
+        entries = self.ledger.entries(last_trip_id)
+        for service in self.services:
+            self._deliver(service, entries, deadline)
+
+        for entry in entries:
+            if not entry.is_skipped() and not all(
+                    entry.is_done(s.NAME) for s in self.services):
+                break
+            last_trip_id = entry.trip.id
         logging.debug('Last trip id: %d' % last_trip_id)
+        logging.info('Citibike cache stats: %s' % self.citibike.fetcher.stats())
+        logging.info('Google cache stats: %s' % self.fetcher.stats())
         return last_trip_id
 
-    def _get_stations(self):
-        return {s.id: s for s in self.citibike.stations()}
-
-    def _get_trips(self, min_id):
+    def rebuild_stats(self):
+        """
+        Counts every trip of the Citibike history with a route in ride_stats,
+        as they are once delivered, and saves them. Returns the number of
+        trips counted.
+        """
+        trips = [t for t in self.citibike.trips(-1, []) if
+                 self._is_valid_trip(t)]
+        pairs = {t.id: self._station_pair(t) for t in trips
+                 if self._has_stations(t)}
+        distances = self.maps.distances(pairs.values(),
+                                        maps.TravelMode.bicycling,
+                                        maps.UnitSystem.metric)
+        counted = 0
+        for trip in sorted(trips, key=lambda t: t.id):
+            if trip.id in pairs and distances[pairs[trip.id]] != None:
+                self.ride_stats.add(trip, distances[pairs[trip.id]],
+                                    self.stations)
+                counted += 1
+        self.ride_stats.changed = True
+        self.ride_stats.save()
+        return counted
+
+    def _get_stations(self, refresh=False):
+        return {s.id: s for s in self.citibike.stations(refresh=refresh)}
+
+    def _get_trips(self, min_id, failures, cursor=None, deadline=None):
         trips = []
-        for trip in self.citibike.trips(min_id):
+        fetched, cursor = self.citibike.resume_trips(min_id, cursor, deadline,
+                                                     failures)
+        for trip in fetched:
             if trip.id > min_id and self._is_valid_trip(trip):
                 trips.append(trip)
         trips.sort(cmp=lambda t1,t2: cmp(t1.id, t2.id))
-        return trips
+        return trips, cursor
+
+    def _record_trips(self, trips, failures=()):
+        """
+        Records trips in order along with their distance, and parks the
+        (trip id, reason) failures. Distances for all trips are fetched from
+        Google Maps in a single batched call. Nothing is recorded if that call
+        fails so the ledger never has a gap. Returns whether trips were
+        recorded.
+        """
+        if not all(self._has_stations(t) for t in trips):
+            # Stations may have opened since they were cached.
+            self._stations = self._get_stations(refresh=True)
+        pairs = {t.id: self._station_pair(t) for t in trips
+                 if self._has_stations(t)}
+        try:
+            distances = self.maps.distances(pairs.values(),
+                                            maps.TravelMode.bicycling,
+                                            maps.UnitSystem.metric)
+        except:
+            logging.exception('Failed to get trip distances: %s'
+                              % sys.exc_info()[0])
+            return False
+
+        for trip_id, reason in failures:
+            self.ledger.park(trip_id, None, reason)
+
+        for trip in trips:
+            logging.debug('Recording trip: %d' % trip.id)
+            if not trip.id in pairs:
+                logging.warning('Unknown station for trip: %d' % trip.id)
+                unknown = [str(id) for id in (trip.start_station,
+                                              trip.end_station)
+                           if id not in self.stations]
+                self.ledger.add(trip, None)
+                self.ledger.park(trip.id, None,
+                                 'Unknown station: %s' % ', '.join(unknown))
+                continue
+            distance = distances[pairs[trip.id]]
+            if distance == None:
+                logging.warning('No distance found for trip: %d' % trip.id)
+                self.ledger.add(trip, None)
+                self.ledger.park(trip.id, None, 'No route between stations')
+                continue
+            self.ledger.add(trip, distance)
+        return True
 
-    def _add_trip(self, trip):
-        if not trip.start_station in self.stations:
-            logging.warning("Invalid start station id: %d", trip.start_station)
-            return
-        if not trip.end_station in self.stations:
-            logging.warning("Invalid end station id: %d", trip.start_station)
-            return
+    def _has_stations(self, trip):
+        return (trip.start_station in self.stations and
+                trip.end_station in self.stations)
 
-        # Get distance between stations from Google Maps.
+    def _station_pair(self, trip):
         orig = self.stations[trip.start_station]
         dest = self.stations[trip.end_station]
-        directions = self.maps.directions((orig.lat, orig.lng),
-                                          (dest.lat, dest.lng),
-                                          maps.TravelMode.bicycling,
-                                          maps.UnitSystem.metric)
-        distance = directions['routes'][0]['legs'][0]['distance']['value']
+        return ((orig.lat, orig.lng), (dest.lat, dest.lng))
 
-        # Add trip to all services.
-        for service in self.services:
-            service.add_trip(trip, distance)
+    def _deliver(self, service, entries, deadline=None):
+        """
+        Adds the trips of entries not yet done with for service, in order.
+        Trips failing permanently, or too many times, are parked. Delivery to
+        the service stops at the first transient failure, the trip being
+        retried with backoff on later updates, or once deadline is passed after
+        at least one trip was added. Failures of the service itself, including
+        connecting to it, stop delivery without counting against the trip.
+        """
+        now = time.time()
+        added = False
+        connected = False
+        for entry in entries:
+            if entry.is_skipped() or entry.is_done(service.NAME):
+                continue
+            if entry.retry_at(service.NAME) > now:
+                continue
+            if added and deadline != None and time.time() > deadline:
+                logging.debug('Deadline passed delivering to %s'
+                              % service.NAME)
+                self.complete = False
+                return
+            if not connected:
+                try:
+                    service.connect()
+                except Exception:
+                    logging.exception('Failed to connect to %s: %s'
+                                      % (service.NAME, sys.exc_info()[0]))
+                    return
+                connected = True
+            try:
+                logging.debug('Adding trip %d to %s'
+                              % (entry.trip.id, service.NAME))
+                service.add_trip(entry.trip, entry.distance)
+            except Exception as e:
+                if service.is_service_failure(e):
+                    logging.exception('%s unavailable, delivery postponed: %s'
+                                      % (service.NAME, sys.exc_info()[0]))
+                    return
+                logging.exception('Failed to add trip to %s: %s'
+                                  % (service.NAME, sys.exc_info()[0]))
+                attempts = entry.attempts(service.NAME) + 1
+                if (service.is_permanent_failure(e) or
+                    attempts >= self.MAX_ATTEMPTS):
+                    reason = '%s failed on attempt %d: %r' % (service.NAME,
+                                                              attempts, e)
+                    self.ledger.mark_parked(entry, service.NAME, reason)
+                    continue
+                retry_at = now + self.RETRY_DELAY * 2**(attempts - 1)
+                self.ledger.retry_later(entry, service.NAME, retry_at)
+                return
+            self.ledger.mark_delivered(entry, service.NAME)
+            if len(entry.delivered) == 1:
+                self.ride_stats.add(entry.trip, entry.distance, self.stations)
+                self.ride_stats.save()
+            added = True
+            time.sleep(1)
 
     def _is_valid_trip(self, trip):
         if trip.end_station == None:
@@ -113,32 +318,93 @@ class Citifit:
 class FitnessService:
     """
     FitnessService provides an interface to add Citibike trips to a service.
+    NAME identifies the service in the trip ledger.
     """
+    NAME = None
+
+    def connect(self):
+        """
+        Prepares the service before trips are added, e.g. looks up ids in the
+        user account. Does nothing once connected.
+        """
+        pass
+
     def add_trip(self, trip, distance):
         raise NotImplementedError("Subclass need implement add_trip.")
 
+    def is_permanent_failure(self, e):
+        """
+        Returns whether e, raised by add_trip, would be raised again for the
+        same trip, e.g. because the service rejected it.
+        """
+        return False
+
+    def is_service_failure(self, e):
+        """
+        Returns whether e, raised by add_trip, is caused by the service rather
+        than the trip, e.g. revoked credentials, rate limiting or an outage,
+        in which case any trip would fail the same way.
+        """
+        return isinstance(e, (IOError, httplib.HTTPException,
+                              httplib2.HttpLib2Error))
+
 class GoogleFitService(FitnessService):
     """
     GoogleFitService is used to add Citibike trips to Google Fit.
     """
+    NAME = 'google_fit'
+
     ACTIVITY_BIKING_VALUE = 1  # Biking
     ACTIVITY_DATA_TYPE_NAME = 'com.google.activity.segment'
     APPLICATION_NAME = 'Citifit'
     APPLICATION_VERSION = '1.0'
     USER_ID = 'me'
+    PERMANENT_STATUSES = [400, 404, 409]
+    SERVICE_FAILURE_STATUSES = [401, 403, 429]
+    DISCOVERY_URL = ('https://www.googleapis.com/discovery/v1/apis/' +
+                     'fitness/v1/rest')
 
-    def __init__(self, credentials, stations):
-        http = credentials.authorize(httplib2.Http())
-        self.service = build('fitness', 'v1', http=http)
+    def __init__(self, credentials, stations, fetcher):
+        """
+        Initializes the service with credentials and stations, a function
+        returning stations by id. The Google Fit client is only built when the
+        first trip is added. Its discovery document is fetched through fetcher
+        so it can be cached for all users.
+        """
+        self.credentials = credentials
         self.stations = stations
-        self.activity_data_source = self._get_activity_data_source()
+        self.fetcher = fetcher
+        self.service = None
+        self.activity_data_source = None
+
+    def connect(self):
         if self.activity_data_source == None:
-            self.activity_data_source = self._create_activity_data_source()
+            self._connect()
 
     def add_trip(self, trip, distance):
+        self.connect()
         self._add_activity(trip)
         self._add_session(trip)
 
+    def is_permanent_failure(self, e):
+        return (isinstance(e, HttpError) and
+                e.resp.status in GoogleFitService.PERMANENT_STATUSES)
+
+    def is_service_failure(self, e):
+        if isinstance(e, HttpError):
+            return (e.resp.status in GoogleFitService.SERVICE_FAILURE_STATUSES
+                    or e.resp.status >= 500)
+        return (isinstance(e, AccessTokenRefreshError) or
+                FitnessService.is_service_failure(self, e))
+
+    def _connect(self):
+        http = self.credentials.authorize(httplib2.Http())
+        discovery = self.fetcher.fetch(GoogleFitService.DISCOVERY_URL).read()
+        self.service = build_from_document(discovery, http=http)
+        self.activity_data_source = self._get_activity_data_source()
+        if self.activity_data_source == None:
+            self.activity_data_source = self._create_activity_data_source()
+
     def _add_session(self, trip):
         def trip_time(trip):
             return trip.start_time.ctime()
@@ -147,8 +413,9 @@ class GoogleFitService(FitnessService):
             return "Citbike Trip on %s" % trip_time(trip)
 
         def trip_description(trip):
-            start_station_name = self.stations[trip.start_station].name
-            end_station_name = self.stations[trip.end_station].name
+            stations = self.stations()
+            start_station_name = stations[trip.start_station].name
+            end_station_name = stations[trip.end_station].name
             return "Citibike ride on %s from %s to %s." % (trip_time(trip),
                                                            start_station_name,
                                                            end_station_name)
@@ -263,14 +530,21 @@ class FitbitService(FitnessService):
     """
     FitbitService is used to add Citibike trips to Fibit.
     """
+    NAME = 'fitbit'
+
     def __init__(self, fitbit_key, fitbit_secret):
         self.fitbit = fitbit.Fitbit(conf.FITBIT_CLIENT_KEY,
                                     conf.FITBIT_CLIENT_SECRET,
                                     resource_owner_key=fitbit_key,
                                     resource_owner_secret=fitbit_secret)
-        self.activity_id = self._get_biking_activity_id()
+        self.activity_id = None
+
+    def connect(self):
+        if self.activity_id == None:
+            self.activity_id = self._get_biking_activity_id()
 
     def add_trip(self, trip, distance):
+        self.connect()
         data = {
             'activityId' : self.activity_id,
             'startTime' : trip.start_time.strftime('%H:%M'),
@@ -283,6 +557,14 @@ class FitbitService(FitnessService):
         response = self.fitbit.log_activity(data)
         logging.debug("Received Fitbit log activity response: %s" % response)
 
+    def is_permanent_failure(self, e):
+        return isinstance(e, (HTTPBadRequest, HTTPConflict, HTTPNotFound))
+
+    def is_service_failure(self, e):
+        return (isinstance(e, (HTTPUnauthorized, HTTPForbidden,
+                               HTTPServerError, HTTPTooManyRequests)) or
+                FitnessService.is_service_failure(self, e))
+
     def _get_biking_activity_id(self):
         logging.debug("Sending Fitbit activity list request")
         activities = self.fitbit.activities_list()
@@ -11,3 +11,7 @@ GOOGLE_FIT_CLIENT_SECRET = ''
 
 # Google API key from https://console.developers.google.com/.
 GOOGLE_API_KEY = ''
+
+# Citibike JSON trip history endpoint. Trips are scraped from the member site
+# if empty.
+CITIBIKE_TRIPS_API_URL = ''
@@ -0,0 +1,262 @@
+import cookielib
+import logging
+import re
+import threading
+import time
+import urllib
+import urllib2
+
+from collections import OrderedDict
+from StringIO import StringIO
+try:
+    from google.appengine.api import memcache
+    found_memcache = True
+except ImportError:
+    found_memcache = False
+
+# Query parameters holding secrets, e.g. API keys. Left out of logs and of
+# cache keys.
+SECRET_PARAMS = ('key',)
+
+def strip_secrets(uri):
+    """
+    Returns uri without its SECRET_PARAMS query parameters.
+    """
+    base, sep, query = uri.partition('?')
+    if not sep:
+        return uri
+    params = [p for p in query.split('&')
+              if p.partition('=')[0] not in SECRET_PARAMS]
+    return base + ('?' + '&'.join(params) if params else '')
+
+class Fetcher:
+    """
+    Fetcher provides an interface to fetch a uri, posting data if any.
+    Responses are file-like objects with a geturl and a getcode method.
+    """
+    def fetch(self, uri, data={}, headers={}):
+        raise NotImplementedError("Subclass need implement fetch.")
+
+class UrllibFetcher(Fetcher):
+    """
+    Fetcher backed by urllib2 keeping cookies across requests. A 304 Not
+    Modified response is returned rather than raised.
+    """
+    def __init__(self):
+        self.cookies = cookielib.LWPCookieJar()
+        handlers = [
+            urllib2.HTTPCookieProcessor(self.cookies),
+        ]
+        self.opener = urllib2.build_opener(*handlers)
+
+    def fetch(self, uri, data={}, headers={}):
+        logging.debug('Fetching %s', strip_secrets(uri))
+        if (len(data) > 0):
+            data = urllib.urlencode(data)
+            req = urllib2.Request(uri, data, headers)
+        else:
+            req = urllib2.Request(uri, headers=headers)
+        try:
+            return self.opener.open(req)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return e
+            raise
+
+class CachedResponse:
+    """
+    Response served from a response cache.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self._file = StringIO(entry.body)
+
+    def geturl(self):
+        return self.entry.url
+
+    def getcode(self):
+        return 200
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+class CacheEntry:
+    """
+    Cached response body along with the validators used to revalidate it and
+    the timestamp until which it is fresh.
+    """
+    def __init__(self, url, body, etag, last_modified, expires):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+class ResponseCache:
+    """
+    ResponseCache provides an interface to store CacheEntry by uri.
+    """
+    def get(self, uri):
+        raise NotImplementedError("Subclass need implement get.")
+
+    def set(self, uri, entry):
+        raise NotImplementedError("Subclass need implement set.")
+
+class MemoryResponseCache(ResponseCache):
+    """
+    Least recently used response cache bounded by the total size of the bodies
+    it holds. Safe to share between threads.
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        with self._lock:
+            entry = self._entries.pop(uri, None)
+            if entry is not None:
+                self._entries[uri] = entry
+            return entry
+
+    def set(self, uri, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(uri, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[uri] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+class MemcacheResponseCache(ResponseCache):
+    """
+    Response cache backed by App Engine memcache, shared by all instances.
+    Entries too large for memcache are not stored.
+    """
+    NAMESPACE = 'fetcher'
+
+    def get(self, uri):
+        if not found_memcache:
+            return None
+        return memcache.get(uri, namespace=MemcacheResponseCache.NAMESPACE)
+
+    def set(self, uri, entry):
+        if not found_memcache:
+            return
+        try:
+            memcache.set(uri, entry, namespace=MemcacheResponseCache.NAMESPACE)
+        except ValueError:
+            logging.debug('Response too large for memcache: %s', uri)
+
+class CachingFetcher(Fetcher):
+    """
+    Fetcher decorator caching GET responses as allowed by their Cache-Control
+    header and revalidating stale ones with If-None-Match and
+    If-Modified-Since. Entries are looked up in memory, then in the optional
+    persistent cache. Uris starting with one of bypass_prefixes, e.g.
+    authenticated per user pages, and posts are never cached. Since caches are
+    shared between users, private responses are never cached either. Entries
+    are keyed by uri without its secret parameters.
+    """
+    # Memory tier shared by all fetchers of an instance by default.
+    _memory = MemoryResponseCache()
+
+    def __init__(self, fetcher, memory=None, persistent=None,
+                 bypass_prefixes=()):
+        self.fetcher = fetcher
+        self.memory = memory or CachingFetcher._memory
+        self.persistent = persistent
+        self.bypass_prefixes = tuple(bypass_prefixes)
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def fetch(self, uri, data={}, headers={}):
+        if len(data) > 0 or uri.startswith(self.bypass_prefixes):
+            return self.fetcher.fetch(uri, data, headers)
+
+        now = time.time()
+        key = strip_secrets(uri)
+        entry = self._get(key)
+        if entry is not None and entry.expires > now:
+            self.hits += 1
+            self.bytes_saved += len(entry.body)
+            logging.debug('Cache hit for %s', key)
+            return CachedResponse(entry)
+
+        headers = dict(headers)
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        resp = self.fetcher.fetch(uri, data, headers)
+
+        if entry is not None and resp.getcode() == 304:
+            self.revalidations += 1
+            self.bytes_saved += len(entry.body)
+            logging.debug('Cache revalidated for %s', key)
+            entry = CacheEntry(entry.url, entry.body, entry.etag,
+                               entry.last_modified,
+                               now + self._max_age(resp.info()))
+            self._set(key, entry)
+            return CachedResponse(entry)
+
+        self.misses += 1
+        info = resp.info()
+        cache_control = (info.getheader('Cache-Control') or '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return resp
+        etag = info.getheader('ETag')
+        last_modified = info.getheader('Last-Modified')
+        max_age = self._max_age(info)
+        if max_age <= 0 and etag is None and last_modified is None:
+            return resp
+
+        entry = CacheEntry(strip_secrets(resp.geturl()), resp.read(), etag,
+                           last_modified, now + max_age)
+        self._set(key, entry)
+        return CachedResponse(entry)
+
+    def stats(self):
+        """
+        Returns the hit, revalidation and miss counts along with the number of
+        bytes not downloaded thanks to the cache.
+        """
+        lookups = self.hits + self.revalidations + self.misses
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'hit_rate': ((self.hits + self.revalidations) / float(lookups)
+                         if lookups > 0 else 0.0),
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def _get(self, uri):
+        entry = self.memory.get(uri)
+        if entry is None and self.persistent is not None:
+            entry = self.persistent.get(uri)
+            if entry is not None:
+                self.memory.set(uri, entry)
+        return entry
+
+    def _set(self, uri, entry):
+        self.memory.set(uri, entry)
+        if self.persistent is not None:
+            self.persistent.set(uri, entry)
+
+    def _max_age(self, info):
+        MAX_AGE_REGEXP = r'(?:s-maxage|max-age)=(\d+)'
+        cache_control = (info.getheader('Cache-Control') or '').lower()
+        if 'no-cache' in cache_control:
+            return 0
+        match = re.search(MAX_AGE_REGEXP, cache_control)
+        if match:
+            return int(match.group(1))
+        return 0
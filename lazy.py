@@ -0,0 +1,16 @@
+import importlib
+
+class LazyModule:
+    """
+    Module proxy deferring the import of a module until one of its attributes
+    is first accessed. Keeps heavy modules out of instance start up when the
+    request being served doesn't use them.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
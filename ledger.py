@@ -0,0 +1,141 @@
+class LedgerEntry:
+    """
+    Citibike trip recorded in a ledger along with its distance and its delivery
+    state for each service: the names of the services it was delivered to, of
+    those it was parked for after a permanent failure, and the number of failed
+    attempts and next retry timestamp for those that failed transiently. A
+    distance of None marks a trip that can't be delivered, e.g. because one of
+    its stations is unknown.
+    """
+    def __init__(self, trip, distance, delivered=(), parked=(), retries=None):
+        self.trip = trip
+        self.distance = distance
+        self.delivered = set(delivered)
+        self.parked = set(parked)
+        self.retries = dict(retries or {})
+
+    def is_skipped(self):
+        return self.distance == None
+
+    def is_delivered(self, service_name):
+        return service_name in self.delivered
+
+    def is_done(self, service_name):
+        """
+        Returns whether the trip needs no more delivery attempt to the service.
+        """
+        return service_name in self.delivered or service_name in self.parked
+
+    def attempts(self, service_name):
+        return self.retries.get(service_name, (0, 0))[0]
+
+    def retry_at(self, service_name):
+        return self.retries.get(service_name, (0, 0))[1]
+
+class DeadLetter:
+    """
+    Trip that failed permanently, for a service or for all services if
+    service_name is None, along with the reason of the failure.
+    """
+    def __init__(self, trip_id, service_name, reason):
+        self.trip_id = trip_id
+        self.service_name = service_name
+        self.reason = reason
+
+class TripLedger:
+    """
+    TripLedger provides an interface to persist parsed Citibike trips, their
+    delivery state for each service and the trips that failed permanently.
+    """
+    def last_trip_id(self):
+        """
+        Returns the id of the newest trip recorded or parked, or 0 if there is
+        none.
+        """
+        raise NotImplementedError("Subclass need implement last_trip_id.")
+
+    def entries(self, min_id=0):
+        """
+        Returns all entries with a trip id greater than min_id, oldest first.
+        """
+        raise NotImplementedError("Subclass need implement entries.")
+
+    def add(self, trip, distance):
+        """
+        Records a trip and its distance. Returns the new entry.
+        """
+        raise NotImplementedError("Subclass need implement add.")
+
+    def save(self, entry):
+        """
+        Persists the delivery state of entry.
+        """
+        raise NotImplementedError("Subclass need implement save.")
+
+    def park(self, trip_id, service_name, reason):
+        """
+        Records a permanent failure of a trip in the dead letter store.
+        """
+        raise NotImplementedError("Subclass need implement park.")
+
+    def dead_letters(self):
+        """
+        Returns all dead letters, newest trip first.
+        """
+        raise NotImplementedError("Subclass need implement dead_letters.")
+
+    def mark_delivered(self, entry, service_name):
+        """
+        Records that the trip of entry was accepted by service_name.
+        """
+        entry.delivered.add(service_name)
+        entry.retries.pop(service_name, None)
+        self.save(entry)
+
+    def mark_parked(self, entry, service_name, reason):
+        """
+        Records that the trip of entry failed permanently for service_name.
+        """
+        entry.parked.add(service_name)
+        entry.retries.pop(service_name, None)
+        self.save(entry)
+        self.park(entry.trip.id, service_name, reason)
+
+    def retry_later(self, entry, service_name, retry_at):
+        """
+        Records a failed attempt to deliver the trip of entry to service_name,
+        to be retried no earlier than the retry_at timestamp.
+        """
+        entry.retries[service_name] = (entry.attempts(service_name) + 1,
+                                       retry_at)
+        self.save(entry)
+
+class MemoryTripLedger(TripLedger):
+    """
+    TripLedger kept in memory. Delivery state is lost once it is discarded.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._dead_letters = []
+
+    def last_trip_id(self):
+        ids = self._entries.keys() + [d.trip_id for d in self._dead_letters]
+        return max(ids) if ids else 0
+
+    def entries(self, min_id=0):
+        return [self._entries[id] for id in sorted(self._entries.keys())
+                if id > min_id]
+
+    def add(self, trip, distance):
+        entry = LedgerEntry(trip, distance)
+        self._entries[trip.id] = entry
+        return entry
+
+    def save(self, entry):
+        pass
+
+    def park(self, trip_id, service_name, reason):
+        self._dead_letters.append(DeadLetter(trip_id, service_name, reason))
+
+    def dead_letters(self):
+        return sorted(self._dead_letters, key=lambda d: -d.trip_id)
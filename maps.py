@@ -32,31 +32,38 @@ class UnitSystem(Enum):
 
 class Maps:
     """
-    Wrapper around the Google Maps Directions API. Details about the API can be
-    found at https://developers.google.com/maps/documentation/directions/.
+    Wrapper around the Google Maps Directions and Distance Matrix APIs. Details
+    about the APIs can be found at
+    https://developers.google.com/maps/documentation/directions/ and
+    https://developers.google.com/maps/documentation/distancematrix/.
     """
     ENDPOINT = 'https://maps.googleapis.com/maps/api/directions/json?'
 
-    def __init__(self, api_key):
+    DISTANCE_MATRIX_ENDPOINT = ('https://maps.googleapis.com/maps/api/' +
+                                'distancematrix/json?')
+
+    # Distance Matrix request limits.
+    MAX_ORIGINS = 25
+    MAX_DESTINATIONS = 25
+    MAX_ELEMENTS = 100
+
+    def __init__(self, api_key, fetcher=None):
         """
         Initializes wrapper with Google API key required to make requests.
+        Requests go through fetcher if provided, e.g. to cache responses.
         """
         self.api_key = api_key
+        self.fetcher = fetcher
 
     def directions(self, origin, destination, mode=None, units=None):
         """
         Gets directions from origin to destination. Uses mode if provided and
         returns response in units if provided.
         """
-        if (isinstance(origin, tuple)):
-            origin = "%f,%f" % origin
-        if (isinstance(destination, tuple)):
-            destination = "%f,%f" % destination
-
         data = {}
         data['key'] = self.api_key
-        data['origin'] = origin
-        data['destination'] = destination
+        data['origin'] = self._location(origin)
+        data['destination'] = self._location(destination)
 
         if mode != None:
             data['mode'] = mode.name
@@ -66,9 +73,81 @@ class Maps:
 
         return self._fetch(data)
 
-    def _fetch(self, data):
-        url = self.ENDPOINT + urllib.urlencode(data)
-        if found_urlfetch:
+    def distances(self, pairs, mode=None, units=None):
+        """
+        Gets the distance in meters between each (origin, destination) pair,
+        batching pairs into as few Distance Matrix requests as the API limits
+        allow. Uses mode if provided. Returns a dict mapping each distinct pair
+        to its distance, or to None if the API found no route for it.
+        """
+        by_origin = {}
+        for origin, destination in pairs:
+            by_origin.setdefault(origin, set()).add(destination)
+
+        distances = {}
+        for origins, destinations in self._batches(by_origin):
+            data = {}
+            data['key'] = self.api_key
+            data['origins'] = '|'.join(self._location(o) for o in origins)
+            data['destinations'] = '|'.join(self._location(d)
+                                            for d in destinations)
+
+            if mode != None:
+                data['mode'] = mode.name
+
+            if units != None:
+                data['units'] = units.name
+
+            resp = self._fetch(data, self.DISTANCE_MATRIX_ENDPOINT)
+            for origin, row in zip(origins, resp['rows']):
+                for destination, elem in zip(destinations, row['elements']):
+                    if destination not in by_origin[origin]:
+                        continue
+                    if elem['status'] == 'OK':
+                        distances[(origin, destination)] = \
+                            elem['distance']['value']
+                    else:
+                        distances[(origin, destination)] = None
+        return distances
+
+    def _batches(self, by_origin):
+        """
+        Groups origins and their destinations into (origins, destinations)
+        batches within the Distance Matrix limits. A request returns the full
+        origins by destinations matrix, so origins are only grouped together
+        while the matrix stays under MAX_ELEMENTS.
+        """
+        origins = []
+        destinations = []
+        for origin in sorted(by_origin.keys()):
+            dests = sorted(by_origin[origin])
+            max_dests = min(self.MAX_DESTINATIONS, self.MAX_ELEMENTS)
+            for i in range(0, len(dests), max_dests):
+                chunk = dests[i:i + max_dests]
+                merged = destinations + [d for d in chunk
+                                         if d not in destinations]
+                if (len(origins) + 1 > self.MAX_ORIGINS or
+                    len(merged) > self.MAX_DESTINATIONS or
+                    (len(origins) + 1) * len(merged) > self.MAX_ELEMENTS):
+                    if origins:
+                        yield origins, destinations
+                    origins = []
+                    merged = chunk
+                origins.append(origin)
+                destinations = merged
+        if origins:
+            yield origins, destinations
+
+    def _location(self, location):
+        if (isinstance(location, tuple)):
+            return "%f,%f" % location
+        return location
+
+    def _fetch(self, data, endpoint=None):
+        url = (endpoint or self.ENDPOINT) + urllib.urlencode(data)
+        if self.fetcher != None:
+            resp = json.load(self.fetcher.fetch(url))
+        elif found_urlfetch:
             resp = json.loads(urlfetch.fetch(url).content)
         else:
             resp = json.load(urllib.urlopen(url))
@@ -0,0 +1,18 @@
+import sys
+
+sys.path.append("./lib/python2.7/site-packages/")
+
+from oauth2client.appengine import OAuth2Decorator
+
+import conf
+
+# Path of the OAuth 2.0 callback, routed to CallbackHandler by app.py.
+CALLBACK_PATH = '/oauth2callback'
+
+decorator = OAuth2Decorator(
+    client_id=conf.GOOGLE_FIT_CLIENT_KEY,
+    client_secret=conf.GOOGLE_FIT_CLIENT_SECRET,
+    scope='https://www.googleapis.com/auth/fitness.activity.write',
+    callback_path=CALLBACK_PATH)
+
+CallbackHandler = decorator.callback_handler()
@@ -0,0 +1,46 @@
+import cProfile
+import marshal
+import pstats
+
+from StringIO import StringIO
+
+class Profile:
+    """
+    Profile of the calls made through run, collected with cProfile. Stats are
+    available even if a profiled call raised.
+    """
+    # Modules summarized separately from the overall hot spots.
+    APP_MODULES = r'citibike\.py|citifit\.py|fetcher\.py|ledger\.py|maps\.py'
+
+    NUM_HOT_SPOTS = 25
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func with args under the profiler and returns its result.
+        """
+        return self.profiler.runcall(func, *args, **kwargs)
+
+    def dump(self):
+        """
+        Returns the raw stats in the format written by pstats dump_stats.
+        """
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+    def summary(self):
+        """
+        Returns the overall hot spots by cumulative time and the hot spots of
+        the application modules by own time.
+        """
+        out = StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.strip_dirs()
+        out.write('Hot spots by cumulative time:\n')
+        stats.sort_stats('cumulative').print_stats(Profile.NUM_HOT_SPOTS)
+        out.write('Application hot spots by own time:\n')
+        stats.sort_stats('time').print_stats(Profile.APP_MODULES,
+                                             Profile.NUM_HOT_SPOTS)
+        return out.getvalue()
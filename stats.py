@@ -0,0 +1,114 @@
+import time
+
+from datetime import datetime
+from datetime import timedelta
+
+class RideStats:
+    """
+    Ride statistics of a user kept as counters updated one trip at a time:
+    totals, buckets by ISO week and by month, and trip counts by station pair.
+    Each bucket holds [trips, meters, seconds]. Only the latest MAX_WEEKS weeks
+    are kept so the stats stay compact. Pairs are counted with the Space-Saving
+    algorithm in at most MAX_PAIRS [count, error] counters: a new pair takes
+    over the counter of the least frequent one, inheriting its count as error,
+    so pairs ridden often enough are always kept whatever order they come in.
+    """
+    MAX_WEEKS = 104
+    MAX_PAIRS = 100
+
+    def __init__(self, totals=None, weeks=None, months=None, pairs=None):
+        self.totals = list(totals or [0, 0, 0])
+        self.weeks = dict(weeks or {})
+        self.months = dict(months or {})
+        self.pairs = dict(pairs or {})
+        self.changed = False
+
+    def add(self, trip, distance, stations):
+        """
+        Counts a trip and its distance. stations maps station ids to stations,
+        used to name the trip station pair.
+        """
+        def count(bucket):
+            bucket[0] += 1
+            bucket[1] += distance
+            bucket[2] += trip.duration
+            return bucket
+
+        self.changed = True
+        count(self.totals)
+        week = RideStats.week(trip.start_time)
+        self.weeks[week] = count(self.weeks.get(week, [0, 0, 0]))
+        month = RideStats.month(trip.start_time)
+        self.months[month] = count(self.months.get(month, [0, 0, 0]))
+        self._count_pair(self._pair_name(trip, stations))
+
+        if len(self.weeks) > RideStats.MAX_WEEKS:
+            for week in sorted(self.weeks.keys())[:-RideStats.MAX_WEEKS]:
+                del self.weeks[week]
+
+    def save(self):
+        """
+        Persists the stats if changed. Nothing to do for stats kept in memory.
+        """
+        pass
+
+    def top_pairs(self, n):
+        """
+        Returns the n most frequent station pairs as (name, trips), trips
+        being the number of trips counted since the pair was last given a
+        counter.
+        """
+        trips = [(name, count - error)
+                 for name, (count, error) in self.pairs.items()]
+        return sorted(trips, key=lambda p: -p[1])[:n]
+
+    def week_bucket(self, dt):
+        return self.weeks.get(RideStats.week(dt), [0, 0, 0])
+
+    def month_bucket(self, dt):
+        return self.months.get(RideStats.month(dt), [0, 0, 0])
+
+    @staticmethod
+    def local_now(timestamp=None):
+        """
+        Returns the current time in New York, where trips are counted, as a
+        naive datetime, or the time of timestamp if given. Applies the US
+        daylight saving time rules itself so pytz isn't loaded to render the
+        stats.
+        """
+        def sunday(year, month, n):
+            first = datetime(year, month, 1)
+            return first + timedelta(days=(6 - first.weekday()) % 7 + 7 * n - 7)
+
+        if timestamp is None:
+            timestamp = time.time()
+        utc = datetime.utcfromtimestamp(timestamp)
+        # Daylight saving time starts at 2am EST on the second Sunday of March
+        # and ends at 2am EDT on the first Sunday of November.
+        dst_start = sunday(utc.year, 3, 2) + timedelta(hours=7)
+        dst_end = sunday(utc.year, 11, 1) + timedelta(hours=6)
+        offset = -4 if dst_start <= utc < dst_end else -5
+        return utc + timedelta(hours=offset)
+
+    @staticmethod
+    def week(dt):
+        year, week, _ = dt.isocalendar()
+        return '%04d-W%02d' % (year, week)
+
+    @staticmethod
+    def month(dt):
+        return dt.strftime('%Y-%m')
+
+    def _count_pair(self, pair):
+        if pair not in self.pairs and len(self.pairs) >= RideStats.MAX_PAIRS:
+            least = min(self.pairs.keys(), key=lambda p: self.pairs[p][0])
+            count, _ = self.pairs.pop(least)
+            self.pairs[pair] = [count, count]
+        counter = self.pairs.setdefault(pair, [0, 0])
+        counter[0] += 1
+
+    def _pair_name(self, trip, stations):
+        def name(id):
+            return stations[id].name if id in stations else str(id)
+
+        return '%s to %s' % (name(trip.start_station), name(trip.end_station))
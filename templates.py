@@ -0,0 +1,70 @@
+import hashlib
+import jinja2
+import json
+import logging
+import os
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Templates precompiled by running this module. Used when up to date.
+COMPILED_DIR = os.path.join(TEMPLATE_DIR, 'compiled_templates')
+
+# Digests of the template sources the compiled templates were built from.
+MANIFEST = os.path.join(COMPILED_DIR, 'manifest.json')
+
+def environment():
+    """
+    Builds the Jinja environment, loading precompiled templates if they were
+    compiled from the current template sources and falling back to compiling
+    the template sources otherwise.
+    """
+    loaders = []
+    if _is_compiled():
+        loaders.append(jinja2.ModuleLoader(COMPILED_DIR))
+    loaders.append(jinja2.FileSystemLoader(TEMPLATE_DIR))
+    return _environment(jinja2.ChoiceLoader(loaders))
+
+def compile_templates():
+    """
+    Precompiles the html templates at the root of TEMPLATE_DIR to COMPILED_DIR.
+    Must be run again before deploying whenever a template changes, stale
+    compiled templates being ignored.
+    """
+    env = _environment(jinja2.FileSystemLoader(TEMPLATE_DIR))
+    env.compile_templates(COMPILED_DIR, filter_func=_is_template, zip=None)
+    with open(MANIFEST, 'w') as f:
+        json.dump(_digests(), f)
+
+def _is_compiled():
+    """
+    Returns whether COMPILED_DIR holds templates compiled from the current
+    template sources. The digests of the sources are compared rather than
+    their modification times since deploys don't preserve them.
+    """
+    if not os.path.isfile(MANIFEST):
+        return False
+    with open(MANIFEST) as f:
+        if json.load(f) == _digests():
+            return True
+    logging.warning('Ignoring stale compiled templates in %s' % COMPILED_DIR)
+    return False
+
+def _digests():
+    digests = {}
+    for name in os.listdir(TEMPLATE_DIR):
+        if _is_template(name):
+            with open(os.path.join(TEMPLATE_DIR, name), 'rb') as f:
+                digests[name] = hashlib.sha1(f.read()).hexdigest()
+    return digests
+
+def _is_template(name):
+    return '/' not in name and name.endswith('.html')
+
+def _environment(loader):
+    return jinja2.Environment(
+        loader=loader,
+        extensions=['jinja2.ext.autoescape'],
+        autoescape=True)
+
+if __name__ == '__main__':
+    compile_templates()
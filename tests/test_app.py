@@ -0,0 +1,162 @@
+import unittest
+import webapp2
+
+from datetime import datetime
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from oauth2client.client import AccessTokenCredentials
+from pytz import timezone
+
+import app
+import citibike
+
+def trip(id):
+    start = datetime.fromtimestamp(id, timezone('US/Eastern'))
+    return citibike.Trip(id, 1, start, 2, start, 600)
+
+class DatastoreTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+class NdbTripLedgerTest(DatastoreTest):
+    def setUp(self):
+        DatastoreTest.setUp(self)
+        self.ledger = app.NdbTripLedger(ndb.Key(app.UserSettings, 'user'))
+
+    def test_empty(self):
+        self.assertEqual(self.ledger.last_trip_id(), 0)
+        self.assertEqual(self.ledger.entries(), [])
+        self.assertEqual(self.ledger.entries(0), [])
+        self.assertEqual(self.ledger.dead_letters(), [])
+
+    def test_entries_oldest_first_after_min_id(self):
+        for id in [3, 1, 2]:
+            self.ledger.add(trip(id), 100)
+        self.assertEqual([e.trip.id for e in self.ledger.entries()],
+                         [1, 2, 3])
+        self.assertEqual([e.trip.id for e in self.ledger.entries(1)], [2, 3])
+
+    def test_entries_are_scoped_to_user(self):
+        self.ledger.add(trip(1), 100)
+        other = app.NdbTripLedger(ndb.Key(app.UserSettings, 'other'))
+        self.assertEqual(other.entries(), [])
+
+    def test_trip_round_trip(self):
+        self.ledger.add(trip(1000), None)
+        entry = self.ledger.entries()[0]
+        self.assertEqual(entry.trip.start_time, trip(1000).start_time)
+        self.assertEqual(entry.trip.duration, 600)
+        self.assertTrue(entry.is_skipped())
+
+    def test_last_trip_id_includes_dead_letters(self):
+        self.ledger.add(trip(5), 100)
+        self.ledger.park(7, None, 'Unknown station')
+        self.assertEqual(self.ledger.last_trip_id(), 7)
+        self.assertEqual(self.ledger.dead_letters()[0].reason,
+                         'Unknown station')
+
+    def test_mark_delivered_is_saved(self):
+        entry = self.ledger.add(trip(1), 100)
+        self.ledger.retry_later(entry, 'fitbit', 1000)
+        self.ledger.mark_delivered(entry, 'fitbit')
+        entry = self.ledger.entries()[0]
+        self.assertTrue(entry.is_delivered('fitbit'))
+        self.assertFalse(entry.is_done('google_fit'))
+
+class FailingModule:
+    def __getattr__(self, name):
+        raise AssertionError('%s accessed' % name)
+
+class UserSettingsTest(DatastoreTest):
+    def test_google_fit_login_checked_without_decoding(self):
+        settings = app.UserSettings(id='user', userid='user')
+        self.assertFalse(settings.is_logged_in_google_fit())
+        settings.google_fit_credentials = AccessTokenCredentials('token',
+                                                                 'agent')
+        self.assertTrue(settings.is_logged_in_google_fit())
+        settings.put()
+        ndb.get_context().clear_cache()
+
+        module = app.oauth2client_client
+        app.oauth2client_client = FailingModule()
+        self.addCleanup(setattr, app, 'oauth2client_client', module)
+        settings = app.UserSettings.get_by_id('user')
+        self.assertTrue(settings.is_logged_in_google_fit())
+
+    def test_google_fit_logged_out(self):
+        settings = app.UserSettings(id='user', userid='user')
+        settings.google_fit_credentials = None
+        settings.put()
+        ndb.get_context().clear_cache()
+        settings = app.UserSettings.get_by_id('user')
+        self.assertFalse(settings.is_logged_in_google_fit())
+
+    def test_get_by_userid_missing(self):
+        self.assertIsNone(app.UserSettings.get_by_userid('user'))
+
+    def test_get_by_userid_migrates_legacy_settings(self):
+        legacy = app.UserSettings(userid='user', citibike_username='bob')
+        legacy.put()
+        app.NdbTripLedger(legacy.key).add(trip(1), 100)
+        app.UserUpdateLock(parent=legacy.key, userid='user', lock=True).put()
+
+        settings = app.UserSettings.get_by_userid('user')
+        self.assertEqual(settings.key, ndb.Key(app.UserSettings, 'user'))
+        self.assertEqual(settings.citibike_username, 'bob')
+        self.assertIsNone(legacy.key.get())
+        ledger = app.NdbTripLedger(settings.key)
+        self.assertEqual([e.trip.id for e in ledger.entries()], [1])
+        lock = app.UserUpdateLock.query(ancestor=settings.key).get()
+        self.assertTrue(lock.lock)
+        self.assertEqual(app.NdbTripLedger(legacy.key).entries(), [])
+
+    def test_migrate_after_concurrent_migration(self):
+        legacy = app.UserSettings(userid='user', citibike_username='bob')
+        legacy.put()
+        settings = app.UserSettings._migrate('user', legacy.key)
+        self.assertEqual(
+            app.UserSettings._migrate('user', legacy.key), settings)
+
+    def test_migrate_deleted_legacy_settings(self):
+        legacy = app.UserSettings(userid='user')
+        legacy.put()
+        legacy.key.delete()
+        self.assertIsNone(app.UserSettings._migrate('user', legacy.key))
+
+class UpdateLockTest(DatastoreTest):
+    def setUp(self):
+        DatastoreTest.setUp(self)
+        self.user = app.UserSettings(id='user', userid='user',
+                                     citibike_username='bob',
+                                     citibike_password='secret')
+        self.user.put()
+
+    def tasks(self):
+        return [t.url for t in self.taskqueue.get_filtered_tasks()]
+
+    def test_enqueue_grabs_lock(self):
+        app.Update._enqueue(self.user)
+        app.Update._enqueue(self.user)
+        self.assertEqual(self.tasks(), ['/update'])
+        app.Update._unlock(self.user)
+        app.Update._enqueue(self.user)
+        self.assertEqual(self.tasks(), ['/update'] * 2)
+
+    def test_rebuild_stats_waits_for_update(self):
+        app.Update._enqueue(self.user)
+        request = webapp2.Request.blank('/admin/rebuild-stats',
+                                        POST={'userid': 'user'})
+        response = request.get_response(app.application)
+        self.assertEqual(response.status_int, 409)
+        self.assertIsNone(app.NdbRideStats(self.user.key).key.get())
+        lock = app.UserUpdateLock.query(ancestor=self.user.key).get()
+        self.assertTrue(lock.lock)
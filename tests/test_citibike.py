@@ -0,0 +1,441 @@
+import json
+import time
+import unittest
+
+from datetime import datetime
+from lxml import etree
+from pytz import timezone
+from StringIO import StringIO
+
+import citibike
+
+from excepts import BadResponse
+
+class FakeResponse(StringIO):
+    def __init__(self, uri, body):
+        StringIO.__init__(self, body)
+        self.uri = uri
+
+    def geturl(self):
+        return self.uri
+
+class FakeFetcher:
+    """
+    Serves the bodies of responses by uri, counting fetches. Unknown uris are
+    redirected to an error page.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.fetches = []
+
+    def fetch(self, uri, data={}, headers={}):
+        self.fetches.append(uri)
+        if uri not in self.responses:
+            return FakeResponse('http://error', '')
+        return FakeResponse(uri, self.responses[uri])
+
+def gbfs_info(stations, last_updated=None, ttl=60):
+    return json.dumps({
+        'last_updated': int(time.time()) if last_updated is None
+                        else last_updated,
+        'ttl': ttl,
+        'data': {'stations': [{
+            'station_id': str(id),
+            'name': name,
+            'lat': 40.7,
+            'lon': -74.0,
+            'capacity': 30,
+        } for id, name in stations]},
+    })
+
+class GbfsStationSourceTest(unittest.TestCase):
+    INFO_URL = 'http://gbfs/station_information.json'
+    STATUS_URL = 'http://gbfs/station_status.json'
+
+    def setUp(self):
+        citibike.GbfsStationSource._info_cache.clear()
+
+    def source(self, info, status='{}'):
+        self.fetcher = FakeFetcher({
+            self.INFO_URL: info,
+            self.STATUS_URL: status,
+        })
+        return citibike.GbfsStationSource(self.fetcher, self.INFO_URL,
+                                          self.STATUS_URL)
+
+    def test_stations(self):
+        source = self.source(gbfs_info([(72, 'W 52 St & 11 Ave')]))
+        [station] = source.stations()
+        self.assertEqual((station.id, station.name, station.total_docks),
+                         (72, 'W 52 St & 11 Ave', 30))
+        self.assertEqual(station.available_bikes, None)
+
+    def test_info_cached_until_ttl(self):
+        source = self.source(gbfs_info([(72, 'A')], ttl=3600))
+        source.stations()
+        source.stations()
+        self.assertEqual(self.fetcher.fetches, [self.INFO_URL])
+
+    def test_info_cached_at_least_min_ttl(self):
+        source = self.source(gbfs_info([(72, 'A')],
+                                       last_updated=time.time() - 120,
+                                       ttl=60))
+        source.stations()
+        source.stations()
+        self.assertEqual(self.fetcher.fetches, [self.INFO_URL])
+
+    def test_info_expired_after_ttl(self):
+        min_ttl = citibike.GbfsStationSource.INFO_MIN_TTL
+        citibike.GbfsStationSource.INFO_MIN_TTL = 0
+        self.addCleanup(setattr, citibike.GbfsStationSource, 'INFO_MIN_TTL',
+                        min_ttl)
+        source = self.source(gbfs_info([(72, 'A')],
+                                       last_updated=time.time() - 120,
+                                       ttl=60))
+        source.stations()
+        source.stations()
+        self.assertEqual(self.fetcher.fetches, [self.INFO_URL] * 2)
+
+    def test_refresh_drops_cached_info(self):
+        source = self.source(gbfs_info([(72, 'A')], ttl=3600))
+        source.stations()
+        source.refresh()
+        source.stations()
+        self.assertEqual(self.fetcher.fetches, [self.INFO_URL] * 2)
+
+    def test_status(self):
+        status = json.dumps({'data': {'stations': [{
+            'station_id': '72',
+            'num_bikes_available': 3,
+            'num_docks_available': 27,
+        }]}})
+        source = self.source(gbfs_info([(72, 'A'), (79, 'B')]), status)
+        stations = source.status(source.stations())
+        self.assertEqual([(s.id, s.available_bikes, s.available_docks)
+                          for s in stations],
+                         [(72, 3, 27), (79, None, None)])
+
+    def test_non_integer_ids(self):
+        info = json.loads(gbfs_info([(72, 'A'), ('66db2fd0', 'B'),
+                                     ('66db3c29', 'C')]))
+        info['data']['stations'][1]['legacy_id'] = '79'
+        status = json.dumps({'data': {'stations': [
+            {'station_id': '66db2fd0', 'legacy_id': '79',
+             'num_bikes_available': 3, 'num_docks_available': 27},
+            {'station_id': '66db3c29', 'num_bikes_available': 1},
+        ]}})
+        source = self.source(json.dumps(info), status)
+        stations = source.status(source.stations())
+        self.assertEqual([(s.id, s.name, s.available_bikes)
+                          for s in stations],
+                         [(72, 'A', None), (79, 'B', 3)])
+
+    def test_empty_feed(self):
+        source = self.source(gbfs_info([]))
+        self.assertRaises(BadResponse, source.stations)
+
+    def test_feed_without_integer_ids(self):
+        source = self.source(gbfs_info([('66db2fd0', 'A')]))
+        self.assertRaises(BadResponse, source.stations)
+
+class FakeStationSource(citibike.StationSource):
+    def __init__(self, stations=None):
+        self._stations = stations
+        self.refreshes = 0
+
+    def stations(self):
+        if self._stations is None:
+            raise BadResponse('Station Fetch Failed', '')
+        return self._stations
+
+    def refresh(self):
+        self.refreshes += 1
+
+class CitibikeStationsTest(unittest.TestCase):
+    def test_falls_back_to_next_source(self):
+        stations = [citibike.Station(72, 'A', 0, 0, 30, None, None)]
+        fallback = FakeStationSource(stations)
+        cb = citibike.Citibike(station_sources=[FakeStationSource(),
+                                                fallback])
+        self.assertEqual(cb.stations(), stations)
+
+    def test_all_sources_fail(self):
+        cb = citibike.Citibike(station_sources=[FakeStationSource()])
+        self.assertRaises(BadResponse, cb.stations)
+
+    def test_refresh(self):
+        source = FakeStationSource([])
+        cb = citibike.Citibike(station_sources=[source])
+        cb.stations()
+        cb.stations(refresh=True)
+        self.assertEqual(source.refreshes, 1)
+
+TRIP_HTML = '''
+<div class="ed-table__item ed-table__item_trip">
+  <div class="ed-table__col trip-start-date">%s</div>
+  <div class="ed-table__col trip-start-station">%s</div>
+  <div class="ed-table__col trip-end-date">%s</div>
+  <div class="ed-table__col trip-end-station">%s</div>
+  <div class="ed-table__col trip-duration">%s</div>
+</div>'''
+
+STATION_IDS = {'A': 1, 'B': 2, 'C': 3}
+
+NEWEST_START = 1420070400
+
+def trip_html(start, duration, orig='A', dest='B'):
+    def date(t):
+        dt = datetime.fromtimestamp(t, timezone('US/Eastern'))
+        return dt.strftime('%m/%d/%Y %I:%M:%S %p')
+
+    if duration is None:
+        return TRIP_HTML % (date(start), orig, '', '', '-')
+    return TRIP_HTML % (date(start), orig, date(start + duration), dest,
+                        '%d min %d s' % (duration // 60, duration % 60))
+
+def trip_pages(trips, page_size=2):
+    """
+    Returns the trip page bodies of trips, given newest first as html.
+    """
+    last = (len(trips) - 1) // page_size
+    return ['<html><body>%s<a href="?pageNumber=%d">Oldest</a></body></html>'
+            % (''.join(trips[i:i + page_size]), last)
+            for i in range(0, len(trips), page_size)]
+
+class HtmlTripSourceTest(unittest.TestCase):
+    MEMBER_ID = 'm1'
+
+    def setUp(self):
+        self.sleep = citibike.time.sleep
+        citibike.time.sleep = lambda seconds: None
+        self.station_loads = 0
+
+    def tearDown(self):
+        citibike.time.sleep = self.sleep
+
+    def source(self, trips, member_id=MEMBER_ID):
+        """
+        Returns a trip source for the trips of MEMBER_ID, given newest first
+        as html, through a Citibike wrapper knowing member_id.
+        """
+        responses = {citibike.Citibike.PROFILE_URL:
+                     '<a href="/profile/trips?memberId=%s">Trips</a>'
+                     % self.MEMBER_ID}
+        for page, body in enumerate(trip_pages(trips)):
+            responses[self.page_url(page)] = body
+        cb = citibike.Citibike(station_sources=[], member_id=member_id)
+        cb.fetcher = self.fetcher = FakeFetcher(responses)
+        return citibike.HtmlTripSource(cb)
+
+    def page_url(self, page, member_id=MEMBER_ID):
+        return citibike.Citibike.TRIP_URL + member_id + '?pageNumber=%d' % page
+
+    def station_ids(self, refresh=False):
+        self.station_loads += 1
+        return STATION_IDS
+
+    def history(self, num_trips):
+        return [trip_html(NEWEST_START - i * 3600, 600)
+                for i in range(num_trips)]
+
+    def test_no_new_trips_fetches_newest_page_only(self):
+        source = self.source([trip_html(NEWEST_START + 60, None)] +
+                             self.history(5))
+        trips, cursor = source.trips(NEWEST_START, self.station_ids)
+        self.assertEqual((trips, cursor), ([], None))
+        self.assertEqual(self.fetcher.fetches, [self.page_url(0)])
+        self.assertEqual(self.station_loads, 0)
+
+    def test_new_trips_across_pages(self):
+        source = self.source(self.history(5))
+        trips, cursor = source.trips(NEWEST_START - 4 * 3600,
+                                     self.station_ids)
+        self.assertEqual([t.id for t in trips],
+                         [NEWEST_START - i * 3600 for i in range(4)])
+        self.assertEqual(cursor, None)
+        self.assertEqual((trips[0].start_station, trips[0].end_station,
+                          trips[0].duration), (1, 2, 600))
+        self.assertEqual(self.station_loads, 1)
+
+    def test_resolves_unknown_member_id(self):
+        source = self.source(self.history(1), member_id=None)
+        source.trips(NEWEST_START, self.station_ids)
+        self.assertEqual(self.fetcher.fetches,
+                         [citibike.Citibike.PROFILE_URL, self.page_url(0)])
+        self.assertEqual(source.citibike.member_id, self.MEMBER_ID)
+
+    def test_resolves_stale_member_id_again(self):
+        source = self.source(self.history(1), member_id='m0')
+        trips, _ = source.trips(-1, self.station_ids)
+        self.assertEqual(len(trips), 1)
+        self.assertEqual(self.fetcher.fetches[-2:],
+                         [citibike.Citibike.PROFILE_URL, self.page_url(0)])
+        self.assertEqual(source.citibike.member_id, self.MEMBER_ID)
+
+    def test_resumes_from_cursor(self):
+        source = self.source(self.history(5))
+        trips, cursor = source.trips(-1, self.station_ids,
+                                     deadline=time.time() - 1)
+        self.assertEqual(len(trips), 2)
+        self.assertEqual(cursor, '1')
+        more, cursor = source.trips(-1, self.station_ids, cursor=cursor)
+        self.assertEqual(cursor, None)
+        self.assertEqual(set(t.id for t in trips + more),
+                         set(NEWEST_START - i * 3600 for i in range(5)))
+
+class StationIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+
+    def load(self, refresh=False):
+        self.loads.append(refresh)
+        return {'A': 1, 'New': 4} if refresh else {'A': 1}
+
+    def test_loaded_on_first_lookup(self):
+        ids = citibike.StationIds(self.load)
+        self.assertEqual(self.loads, [])
+        self.assertEqual(ids['A'], 1)
+        self.assertEqual(ids['A'], 1)
+        self.assertEqual(self.loads, [False])
+
+    def test_refreshed_once_on_unknown_name(self):
+        ids = citibike.StationIds(self.load)
+        self.assertEqual(ids['New'], 4)
+        self.assertRaises(KeyError, lambda: ids['Closed'])
+        self.assertEqual(self.loads, [False, True])
+
+class ParseTripsTest(unittest.TestCase):
+    def elements(self, *trips):
+        html = etree.fromstring(''.join(trips), etree.HTMLParser())
+        return html.xpath('//div[contains(@class, "ed-table__item_trip")]')
+
+    def test_unknown_station_is_a_failure(self):
+        source = citibike.HtmlTripSource(None)
+        elems = self.elements(trip_html(NEWEST_START, 600),
+                              trip_html(NEWEST_START - 3600, 600, dest='X'))
+        failures = []
+        trips, done = source._parse_trips(elems, STATION_IDS, -1, failures)
+        self.assertEqual([t.id for t in trips], [NEWEST_START])
+        self.assertEqual([id for id, _ in failures], [NEWEST_START - 3600])
+
+    def test_layout_change_fails_the_page(self):
+        elems = self.elements(trip_html(NEWEST_START, 600).replace(
+            'trip-end-date', 'trip-ended'))
+        self.assertRaises(BadResponse,
+                          citibike.HtmlTripSource(None)._parse_trips,
+                          elems, STATION_IDS, -1, [])
+
+    def test_malformed_trip_is_a_failure(self):
+        source = citibike.HtmlTripSource(None)
+        elems = self.elements(
+            trip_html(NEWEST_START, 600).replace('10 min 0 s', '600 s'),
+            trip_html(NEWEST_START - 3600, 600))
+        failures = []
+        trips, done = source._parse_trips(elems, STATION_IDS, -1, failures)
+        self.assertEqual([t.id for t in trips], [NEWEST_START - 3600])
+        self.assertEqual([id for id, _ in failures], [NEWEST_START])
+
+    def test_malformed_trip_before_known_trips_is_a_failure(self):
+        source = citibike.HtmlTripSource(None)
+        elems = self.elements(
+            trip_html(NEWEST_START, 600).replace('10 min 0 s', '600 s'),
+            trip_html(NEWEST_START - 3600, 600))
+        failures = []
+        trips, done = source._parse_trips(elems, STATION_IDS,
+                                          NEWEST_START - 3600, failures)
+        self.assertEqual(trips, [])
+        self.assertTrue(done)
+        self.assertEqual([id for id, _ in failures], [NEWEST_START])
+
+    def test_malformed_start_time_is_skipped(self):
+        source = citibike.HtmlTripSource(None)
+        bad = trip_html(NEWEST_START, 600)
+        start = bad.split('trip-start-date">')[1].split('<')[0]
+        elems = self.elements(bad.replace(start, 'yesterday'),
+                              trip_html(NEWEST_START - 3600, 600))
+        failures = []
+        trips, done = source._parse_trips(elems, STATION_IDS, -1, failures)
+        self.assertEqual([t.id for t in trips], [NEWEST_START - 3600])
+        self.assertEqual(failures, [])
+
+class JsonTripSourceTest(unittest.TestCase):
+    URL = 'http://api/trips'
+
+    def source(self, trips, page_size=2):
+        """
+        Returns a trip source for the trip documents trips, newest first.
+        """
+        responses = {}
+        for i in range(0, len(trips), page_size):
+            next_cursor = i + page_size
+            url = self.URL + ('?cursor=%d' % i if i > 0 else '')
+            responses[url] = json.dumps({
+                'trips': trips[i:next_cursor],
+                'next_cursor': (str(next_cursor) if next_cursor < len(trips)
+                                else None),
+            })
+        cb = citibike.Citibike(station_sources=[])
+        cb.fetcher = self.fetcher = FakeFetcher(responses)
+        return citibike.JsonTripSource(cb, self.URL)
+
+    def trip(self, start, duration=600):
+        return {'start_station_id': 72, 'start_time': start,
+                'end_station_id': 79, 'end_time': start + duration,
+                'duration': duration}
+
+    def history(self, num_trips):
+        return [self.trip(NEWEST_START - i * 3600) for i in range(num_trips)]
+
+    def station_ids(self, refresh=False):
+        self.fail('Stations loaded')
+
+    def test_pages_down_to_known_trips(self):
+        source = self.source(self.history(5))
+        trips, cursor = source.trips(NEWEST_START - 3 * 3600,
+                                     self.station_ids)
+        self.assertEqual([t.id for t in trips],
+                         [NEWEST_START - i * 3600 for i in range(3)])
+        self.assertEqual(cursor, None)
+        self.assertEqual(len(self.fetcher.fetches), 2)
+        self.assertEqual((trips[0].start_station, trips[0].end_station,
+                          trips[0].duration), (72, 79, 600))
+
+    def test_skips_trips_in_progress(self):
+        in_progress = self.trip(NEWEST_START + 3600)
+        in_progress['end_time'] = None
+        source = self.source([in_progress] + self.history(1))
+        trips, _ = source.trips(-1, self.station_ids)
+        self.assertEqual([t.id for t in trips], [NEWEST_START])
+
+    def test_trips_without_start_time_dont_end_the_scan(self):
+        history = self.history(4)
+        del history[1]['start_time']
+        history[2]['start_time'] = 'yesterday'
+        failures = []
+        source = self.source(history)
+        trips, cursor = source.trips(-1, self.station_ids, failures)
+        self.assertEqual([t.id for t in trips],
+                         [NEWEST_START, NEWEST_START - 3 * 3600])
+        self.assertEqual(cursor, None)
+        self.assertEqual(failures, [])
+
+    def test_unparsable_trips_are_failures(self):
+        history = self.history(2)
+        del history[0]['end_station_id']
+        failures = []
+        trips, _ = self.source(history).trips(-1, self.station_ids, failures)
+        self.assertEqual([t.id for t in trips], [NEWEST_START - 3600])
+        self.assertEqual([id for id, _ in failures], [NEWEST_START])
+
+    def test_resumes_from_cursor(self):
+        source = self.source(self.history(5))
+        trips, cursor = source.trips(-1, self.station_ids,
+                                     deadline=time.time() - 1)
+        self.assertEqual((len(trips), cursor), (2, '2'))
+        more, cursor = source.trips(-1, self.station_ids, cursor=cursor)
+        self.assertEqual(cursor, None)
+        self.assertEqual([t.id for t in trips + more],
+                         [NEWEST_START - i * 3600 for i in range(5)])
+
+if __name__ == '__main__':
+    unittest.main()
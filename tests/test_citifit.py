@@ -0,0 +1,288 @@
+import unittest
+
+from datetime import datetime
+from pytz import timezone
+
+import citibike
+import citifit
+import stats
+
+from apiclient.errors import HttpError
+from excepts import BadResponse
+from fitbit.exceptions import HTTPBadRequest
+from fitbit.exceptions import HTTPConflict
+from fitbit.exceptions import HTTPServerError
+from fitbit.exceptions import HTTPTooManyRequests
+from fitbit.exceptions import HTTPUnauthorized
+from oauth2client.client import AccessTokenRefreshError
+
+def trip(id):
+    start = datetime.fromtimestamp(id, timezone('US/Eastern'))
+    return citibike.Trip(id, 1, start, 2, start, 600)
+
+class FakeService(citifit.FitnessService):
+    """
+    Service raising the errors of failures by trip id, or when connecting if
+    connect_error is set.
+    """
+    NAME = 'fake'
+
+    def __init__(self, failures=None, connect_error=None):
+        self.failures = failures or {}
+        self.connect_error = connect_error
+        self.added = []
+
+    def connect(self):
+        if self.connect_error is not None:
+            raise self.connect_error
+
+    def add_trip(self, trip, distance):
+        if trip.id in self.failures:
+            raise self.failures[trip.id]
+        self.added.append(trip.id)
+
+    def is_permanent_failure(self, e):
+        return isinstance(e, HTTPBadRequest)
+
+    def is_service_failure(self, e):
+        return (isinstance(e, HTTPUnauthorized) or
+                citifit.FitnessService.is_service_failure(self, e))
+
+class FakeHttpResponse:
+    status_code = 400
+    content = '{"errors": [{"message": "Rejected"}]}'
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.sleep = citifit.time.sleep
+        citifit.time.sleep = lambda seconds: None
+        self.cf = citifit.Citifit(None, None)
+        self.cf._stations = {}
+        self.ledger = self.cf.ledger
+        for id in [1, 2, 3]:
+            self.ledger.add(trip(id), 1000)
+
+    def tearDown(self):
+        citifit.time.sleep = self.sleep
+
+    def deliver(self, service):
+        self.cf._deliver(service, self.ledger.entries())
+
+    def test_delivers_in_order(self):
+        service = FakeService()
+        self.deliver(service)
+        self.assertEqual(service.added, [1, 2, 3])
+        self.assertTrue(all(e.is_delivered('fake')
+                            for e in self.ledger.entries()))
+
+    def test_parks_permanent_failures(self):
+        service = FakeService({2: HTTPBadRequest(FakeHttpResponse())})
+        self.deliver(service)
+        self.assertEqual(service.added, [1, 3])
+        [dead] = self.ledger.dead_letters()
+        self.assertEqual((dead.trip_id, dead.service_name), (2, 'fake'))
+
+    def test_retries_transient_failures_later(self):
+        service = FakeService({2: ValueError()})
+        self.deliver(service)
+        self.assertEqual(service.added, [1])
+        entry = self.ledger.entries(1)[0]
+        self.assertEqual(entry.attempts('fake'), 1)
+        self.assertTrue(entry.retry_at('fake') > 0)
+
+        # Later runs skip the trip until its retry time.
+        self.deliver(service)
+        self.assertEqual(service.added, [1, 3])
+
+    def test_parks_after_max_attempts(self):
+        service = FakeService({1: ValueError()})
+        entry = self.ledger.entries()[0]
+        for attempt in range(citifit.Citifit.MAX_ATTEMPTS - 1):
+            self.ledger.retry_later(entry, 'fake', 0)
+        self.deliver(service)
+        self.assertTrue(entry.is_done('fake'))
+        self.assertFalse(entry.is_delivered('fake'))
+        self.assertEqual(service.added, [2, 3])
+
+    def test_service_failure_leaves_trips_untouched(self):
+        for error in [HTTPUnauthorized(FakeHttpResponse()), IOError()]:
+            service = FakeService({1: error})
+            self.deliver(service)
+            self.assertEqual(service.added, [])
+            for entry in self.ledger.entries():
+                self.assertFalse(entry.is_done('fake'))
+                self.assertEqual(entry.attempts('fake'), 0)
+        self.assertEqual(self.ledger.dead_letters(), [])
+
+    def test_connect_failure_leaves_trips_untouched(self):
+        service = FakeService(connect_error=ValueError())
+        self.deliver(service)
+        self.assertEqual(service.added, [])
+        for entry in self.ledger.entries():
+            self.assertEqual(entry.attempts('fake'), 0)
+
+class FakeHttplib2Response(dict):
+    def __init__(self, status):
+        dict.__init__(self)
+        self.status = status
+        self.reason = ''
+
+class FailureClassificationTest(unittest.TestCase):
+    def assertClassified(self, service, e, permanent, service_failure):
+        self.assertEqual(service.is_permanent_failure(e), permanent)
+        self.assertEqual(service.is_service_failure(e), service_failure)
+
+    def test_fitbit(self):
+        service = citifit.FitbitService('key', 'secret')
+        response = FakeHttpResponse()
+        self.assertClassified(service, HTTPBadRequest(response), True, False)
+        self.assertClassified(service, HTTPConflict(response), True, False)
+        for e in [HTTPUnauthorized(response), HTTPServerError(response),
+                  HTTPTooManyRequests(response), IOError()]:
+            self.assertClassified(service, e, False, True)
+        self.assertClassified(service, ValueError(), False, False)
+
+    def test_google_fit(self):
+        service = citifit.GoogleFitService(None, None, None)
+
+        def error(status):
+            return HttpError(FakeHttplib2Response(status), '')
+
+        self.assertClassified(service, error(400), True, False)
+        self.assertClassified(service, error(409), True, False)
+        for e in [error(401), error(403), error(429), error(503),
+                  AccessTokenRefreshError()]:
+            self.assertClassified(service, e, False, True)
+        self.assertClassified(service, KeyError(), False, False)
+
+class FakeTripSource(citibike.TripSource):
+    """
+    Serves trips newest first, one page of page_size trips per deadline.
+    Cursors are trip indexes.
+    """
+    def __init__(self, trips, page_size=2):
+        self._trips = sorted(trips, key=lambda t: -t.id)
+        self.page_size = page_size
+
+    def trips(self, min_id, station_ids, failures=None, cursor=None,
+              deadline=None):
+        start = int(cursor or 0)
+        end = len(self._trips)
+        if deadline is not None:
+            end = min(start + self.page_size, end)
+        trips = [t for t in self._trips[start:end] if t.id > min_id]
+        if end < len(self._trips) and len(trips) == end - start:
+            return trips, str(end)
+        return trips, None
+
+class FailingTripSource(citibike.TripSource):
+    def trips(self, min_id, station_ids, failures=None, cursor=None,
+              deadline=None):
+        raise BadResponse('Trip Parse Failed', '')
+
+class SavedRideStats(stats.RideStats):
+    def __init__(self):
+        stats.RideStats.__init__(self)
+        self.saved = []
+
+    def save(self):
+        if self.changed:
+            self.saved.append(self.totals[0])
+            self.changed = False
+
+class FakeMaps:
+    def distances(self, pairs, mode=None, units=None):
+        return {pair: 1000 for pair in pairs}
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.sleep = citifit.time.sleep
+        citifit.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        citifit.time.sleep = self.sleep
+
+    def citifit(self, trips, services=()):
+        cf = citifit.Citifit(None, None, ride_stats=SavedRideStats())
+        cf.citibike.username = cf.citibike.password = 'member'
+        cf.citibike.trip_source = FakeTripSource(trips)
+        cf.maps = FakeMaps()
+        cf._stations = {
+            1: citibike.Station(1, 'A', 40.7, -74.0, 30, None, None),
+            2: citibike.Station(2, 'B', 40.8, -74.0, 30, None, None),
+        }
+        cf.services = list(services)
+        return cf
+
+    def test_checkpoints_until_all_trips_fetched(self):
+        service = FakeService()
+        cf = self.citifit([trip(id) for id in range(1, 6)], [service])
+        last_trip_id = cf.update(0, deadline=0)
+        self.assertEqual(cf.checkpoint, {'min_id': 0, 'cursor': '2'})
+        last_trip_id = cf.update(last_trip_id, 0, cf.checkpoint)
+        self.assertEqual(cf.checkpoint, {'min_id': 0, 'cursor': '4'})
+        self.assertFalse(cf.complete)
+        self.assertEqual(service.added, [])
+
+        # Trips are delivered once all are fetched, one per update here.
+        while True:
+            last_trip_id = cf.update(last_trip_id, 0, cf.checkpoint)
+            if cf.complete:
+                break
+        self.assertEqual(cf.checkpoint, None)
+        self.assertEqual(service.added, [1, 2, 3, 4, 5])
+        self.assertEqual(last_trip_id, 5)
+
+    def test_counts_trips_on_first_delivery(self):
+        fitbit = FakeService()
+        google_fit = FakeService()
+        google_fit.NAME = 'google_fit'
+        cf = self.citifit([trip(1), trip(2)], [fitbit, google_fit])
+        cf.update(0)
+        self.assertEqual(cf.ride_stats.totals, [2, 2000, 1200])
+        self.assertEqual(cf.ride_stats.saved, [1, 2])
+
+    def test_rebuilds_stats_from_history(self):
+        history = [trip(1), trip(2), trip(3)]
+        history[1].end_station = 9
+        cf = self.citifit(history)
+        self.assertEqual(cf.rebuild_stats(), 2)
+        self.assertEqual(cf.ride_stats.totals, [2, 2000, 1200])
+        self.assertEqual(cf.ride_stats.saved, [2])
+
+    def test_keeps_checkpoint_without_services(self):
+        cf = self.citifit([trip(id) for id in range(1, 6)])
+        checkpoint = {'min_id': 0, 'cursor': '2'}
+        self.assertEqual(cf.update(0, checkpoint=checkpoint), 0)
+        self.assertEqual(cf.checkpoint, checkpoint)
+
+    def test_parks_trips_with_unknown_station(self):
+        service = FakeService()
+        history = [trip(1), trip(2)]
+        history[1].end_station = 9
+        cf = self.citifit(history, [service])
+        cf._get_stations = lambda refresh=False: cf._stations
+        self.assertEqual(cf.update(0), 2)
+        self.assertEqual(service.added, [1])
+        self.assertEqual([(d.trip_id, d.reason)
+                          for d in cf.ledger.dead_letters()],
+                         [(2, 'Unknown station: 9')])
+
+    def test_fetch_failure_keeps_checkpoint(self):
+        cf = self.citifit([], [FakeService()])
+        cf.citibike.trip_source = FailingTripSource()
+        checkpoint = {'min_id': 0, 'cursor': '2'}
+        self.assertEqual(cf.update(0, checkpoint=checkpoint), 0)
+        self.assertEqual(cf.checkpoint, checkpoint)
+        self.assertTrue(cf.complete)
+
+    def test_fetch_failure_delivers_recorded_trips(self):
+        service = FakeService()
+        cf = self.citifit([], [service])
+        cf.ledger.add(trip(1), 1000)
+        cf.citibike.trip_source = FailingTripSource()
+        self.assertEqual(cf.update(0), 1)
+        self.assertEqual(service.added, [1])
+
+if __name__ == '__main__':
+    unittest.main()
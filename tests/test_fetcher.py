@@ -0,0 +1,150 @@
+import unittest
+
+from StringIO import StringIO
+
+import fetcher
+
+class FakeInfo:
+    def __init__(self, headers):
+        self.headers = headers
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+class FakeResponse:
+    def __init__(self, uri, code, body, headers):
+        self.uri = uri
+        self.code = code
+        self._file = StringIO(body)
+        self.headers = headers
+
+    def geturl(self):
+        return self.uri
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return FakeInfo(self.headers)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+class FakeFetcher(fetcher.Fetcher):
+    """
+    Serves body with headers, or a 304 if the request If-None-Match matches
+    the ETag header. Records the headers of each request.
+    """
+    def __init__(self, body='body', headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self.requests = []
+
+    def fetch(self, uri, data={}, headers={}):
+        self.requests.append(headers)
+        etag = self.headers.get('ETag')
+        if etag is not None and headers.get('If-None-Match') == etag:
+            return FakeResponse(uri, 304, '', self.headers)
+        return FakeResponse(uri, 200, self.body, self.headers)
+
+class StripSecretsTest(unittest.TestCase):
+    def test_strip_secrets(self):
+        self.assertEqual(fetcher.strip_secrets('http://a/b?key=1&x=2'),
+                         'http://a/b?x=2')
+        self.assertEqual(fetcher.strip_secrets('http://a/b?x=2&key=1'),
+                         'http://a/b?x=2')
+        self.assertEqual(fetcher.strip_secrets('http://a/b?key=1'),
+                         'http://a/b')
+        self.assertEqual(fetcher.strip_secrets('http://a/b?monkey=1'),
+                         'http://a/b?monkey=1')
+        self.assertEqual(fetcher.strip_secrets('http://a/b'), 'http://a/b')
+
+class MemoryResponseCacheTest(unittest.TestCase):
+    def entry(self, body):
+        return fetcher.CacheEntry('u', body, None, None, 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = fetcher.MemoryResponseCache(max_bytes=10)
+        cache.set('a', self.entry('aaaa'))
+        cache.set('b', self.entry('bbbb'))
+        cache.get('a')
+        cache.set('c', self.entry('cccc'))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a').body, 'aaaa')
+        self.assertEqual(cache.size, 8)
+
+    def test_too_large(self):
+        cache = fetcher.MemoryResponseCache(max_bytes=2)
+        cache.set('a', self.entry('aaaa'))
+        self.assertEqual(cache.get('a'), None)
+
+class CachingFetcherTest(unittest.TestCase):
+    URI = 'http://example.com/feed.json'
+
+    def caching_fetcher(self, upstream, **kwargs):
+        return fetcher.CachingFetcher(
+            upstream, memory=fetcher.MemoryResponseCache(), **kwargs)
+
+    def test_fresh_hit(self):
+        upstream = FakeFetcher(headers={'Cache-Control': 'max-age=60'})
+        caching = self.caching_fetcher(upstream)
+        self.assertEqual(caching.fetch(self.URI).read(), 'body')
+        self.assertEqual(caching.fetch(self.URI).read(), 'body')
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual((caching.hits, caching.misses), (1, 1))
+        self.assertEqual(caching.stats()['bytes_saved'], 4)
+
+    def test_revalidation(self):
+        upstream = FakeFetcher(headers={'ETag': '"v1"'})
+        caching = self.caching_fetcher(upstream)
+        caching.fetch(self.URI)
+        resp = caching.fetch(self.URI)
+        self.assertEqual(resp.getcode(), 200)
+        self.assertEqual(resp.read(), 'body')
+        self.assertEqual(upstream.requests[1]['If-None-Match'], '"v1"')
+        self.assertEqual(caching.revalidations, 1)
+
+    def test_not_cacheable(self):
+        for cache_control in ['no-store', 'private, max-age=60']:
+            upstream = FakeFetcher(headers={'Cache-Control': cache_control,
+                                            'ETag': '"v1"'})
+            caching = self.caching_fetcher(upstream)
+            caching.fetch(self.URI)
+            caching.fetch(self.URI)
+            self.assertEqual(upstream.requests[1], {})
+            self.assertEqual(caching.misses, 2)
+
+    def test_bypass(self):
+        upstream = FakeFetcher(headers={'Cache-Control': 'max-age=60'})
+        caching = self.caching_fetcher(upstream,
+                                       bypass_prefixes=['http://example.com/'])
+        caching.fetch(self.URI)
+        caching.fetch(self.URI)
+        self.assertEqual(len(upstream.requests), 2)
+
+    def test_post_not_cached(self):
+        upstream = FakeFetcher(headers={'Cache-Control': 'max-age=60'})
+        caching = self.caching_fetcher(upstream)
+        caching.fetch(self.URI, {'a': 'b'})
+        caching.fetch(self.URI, {'a': 'b'})
+        self.assertEqual(len(upstream.requests), 2)
+
+    def test_persistent_tier(self):
+        upstream = FakeFetcher(headers={'Cache-Control': 'max-age=60'})
+        persistent = fetcher.MemoryResponseCache()
+        self.caching_fetcher(upstream, persistent=persistent).fetch(self.URI)
+        caching = self.caching_fetcher(upstream, persistent=persistent)
+        self.assertEqual(caching.fetch(self.URI).read(), 'body')
+        self.assertEqual(len(upstream.requests), 1)
+
+    def test_secrets_not_in_cache_keys(self):
+        upstream = FakeFetcher(headers={'Cache-Control': 'max-age=60'})
+        memory = fetcher.MemoryResponseCache()
+        caching = fetcher.CachingFetcher(upstream, memory=memory)
+        caching.fetch(self.URI + '?key=secret&x=1')
+        self.assertEqual(list(memory._entries.keys()), [self.URI + '?x=1'])
+        self.assertEqual(memory.get(self.URI + '?x=1').url,
+                         self.URI + '?x=1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import sys
+import unittest
+
+from lazy import LazyModule
+
+class LazyModuleTest(unittest.TestCase):
+    def test_imported_on_first_attribute(self):
+        sys.modules.pop('colorsys', None)
+        colorsys = LazyModule('colorsys')
+        self.assertFalse('colorsys' in sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertTrue('colorsys' in sys.modules)
+
+    def test_missing_module(self):
+        missing = LazyModule('no_such_module')
+        self.assertRaises(ImportError, lambda: missing.anything)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+import ledger
+
+class FakeTrip:
+    def __init__(self, id):
+        self.id = id
+
+class MemoryTripLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.ledger = ledger.MemoryTripLedger()
+
+    def test_empty(self):
+        self.assertEqual(self.ledger.last_trip_id(), 0)
+        self.assertEqual(self.ledger.entries(), [])
+        self.assertEqual(self.ledger.dead_letters(), [])
+
+    def test_entries_oldest_first_after_min_id(self):
+        for id in [3, 1, 2]:
+            self.ledger.add(FakeTrip(id), 100)
+        self.assertEqual([e.trip.id for e in self.ledger.entries()],
+                         [1, 2, 3])
+        self.assertEqual([e.trip.id for e in self.ledger.entries(1)], [2, 3])
+
+    def test_last_trip_id_includes_dead_letters(self):
+        self.ledger.add(FakeTrip(5), 100)
+        self.ledger.park(7, None, 'Unknown station')
+        self.assertEqual(self.ledger.last_trip_id(), 7)
+
+    def test_skipped(self):
+        self.assertTrue(self.ledger.add(FakeTrip(1), None).is_skipped())
+        self.assertFalse(self.ledger.add(FakeTrip(2), 0).is_skipped())
+
+    def test_mark_delivered_clears_retries(self):
+        entry = self.ledger.add(FakeTrip(1), 100)
+        self.ledger.retry_later(entry, 'fitbit', 1000)
+        self.ledger.mark_delivered(entry, 'fitbit')
+        self.assertTrue(entry.is_delivered('fitbit'))
+        self.assertTrue(entry.is_done('fitbit'))
+        self.assertFalse(entry.is_done('google_fit'))
+        self.assertEqual(entry.attempts('fitbit'), 0)
+
+    def test_retry_later_counts_attempts(self):
+        entry = self.ledger.add(FakeTrip(1), 100)
+        self.ledger.retry_later(entry, 'fitbit', 1000)
+        self.ledger.retry_later(entry, 'fitbit', 2000)
+        self.assertEqual(entry.attempts('fitbit'), 2)
+        self.assertEqual(entry.retry_at('fitbit'), 2000)
+        self.assertFalse(entry.is_done('fitbit'))
+
+    def test_mark_parked_records_dead_letter(self):
+        entry = self.ledger.add(FakeTrip(1), 100)
+        self.ledger.retry_later(entry, 'fitbit', 1000)
+        self.ledger.mark_parked(entry, 'fitbit', 'Rejected')
+        self.assertTrue(entry.is_done('fitbit'))
+        self.assertFalse(entry.is_delivered('fitbit'))
+        self.assertEqual(entry.attempts('fitbit'), 0)
+        [dead] = self.ledger.dead_letters()
+        self.assertEqual((dead.trip_id, dead.service_name, dead.reason),
+                         (1, 'fitbit', 'Rejected'))
+
+    def test_dead_letters_newest_first(self):
+        for id in [1, 3, 2]:
+            self.ledger.park(id, None, 'Unknown station')
+        self.assertEqual([d.trip_id for d in self.ledger.dead_letters()],
+                         [3, 2, 1])
+
+if __name__ == '__main__':
+    unittest.main()
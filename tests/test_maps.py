@@ -0,0 +1,90 @@
+import json
+import unittest
+import urlparse
+
+from StringIO import StringIO
+
+import maps
+
+class FakeFetcher:
+    """
+    Answers Distance Matrix requests with a distance of origin * 1000 +
+    destination meters, or no route if the destination is in no_route.
+    """
+    def __init__(self, no_route=()):
+        self.no_route = no_route
+        self.requests = []
+
+    def fetch(self, uri, data={}, headers={}):
+        query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+        origins = query['origins'][0].split('|')
+        destinations = query['destinations'][0].split('|')
+        self.requests.append((origins, destinations))
+
+        def element(o, d):
+            if d in self.no_route:
+                return {'status': 'ZERO_RESULTS'}
+            return {'status': 'OK',
+                    'distance': {'value': int(o) * 1000 + int(d)}}
+
+        return StringIO(json.dumps({
+            'status': 'OK',
+            'rows': [{'elements': [element(o, d) for d in destinations]}
+                     for o in origins],
+        }))
+
+class BatchesTest(unittest.TestCase):
+    def check_limits(self, batches):
+        for origins, destinations in batches:
+            self.assertTrue(len(origins) <= maps.Maps.MAX_ORIGINS)
+            self.assertTrue(len(destinations) <= maps.Maps.MAX_DESTINATIONS)
+            self.assertTrue(len(origins) * len(destinations) <=
+                            maps.Maps.MAX_ELEMENTS)
+
+    def covered(self, batches):
+        return set((o, d) for origins, destinations in batches
+                   for o in origins for d in destinations)
+
+    def test_covers_all_pairs_within_limits(self):
+        by_origin = {o: set(range(o, o + 7)) for o in range(60)}
+        batches = list(maps.Maps('key')._batches(by_origin))
+        self.check_limits(batches)
+        pairs = set((o, d) for o, ds in by_origin.items() for d in ds)
+        self.assertTrue(pairs <= self.covered(batches))
+
+    def test_splits_destinations_of_an_origin(self):
+        by_origin = {1: set(range(60))}
+        batches = list(maps.Maps('key')._batches(by_origin))
+        self.check_limits(batches)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(self.covered(batches),
+                         set((1, d) for d in range(60)))
+
+    def test_groups_origins_sharing_destinations(self):
+        by_origin = {o: set([1, 2]) for o in range(10)}
+        batches = list(maps.Maps('key')._batches(by_origin))
+        self.assertEqual(len(batches), 1)
+
+    def test_empty(self):
+        self.assertEqual(list(maps.Maps('key')._batches({})), [])
+
+class DistancesTest(unittest.TestCase):
+    def test_distances_by_pair(self):
+        fetcher = FakeFetcher(no_route=['9'])
+        pairs = [('1', '2'), ('1', '3'), ('4', '2'), ('1', '2'), ('5', '9')]
+        distances = maps.Maps('key', fetcher).distances(pairs)
+        self.assertEqual(distances, {
+            ('1', '2'): 1002,
+            ('1', '3'): 1003,
+            ('4', '2'): 4002,
+            ('5', '9'): None,
+        })
+        self.assertEqual(len(fetcher.requests), 1)
+
+    def test_no_pairs(self):
+        fetcher = FakeFetcher()
+        self.assertEqual(maps.Maps('key', fetcher).distances([]), {})
+        self.assertEqual(fetcher.requests, [])
+
+if __name__ == '__main__':
+    unittest.main()
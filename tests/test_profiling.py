@@ -0,0 +1,27 @@
+import marshal
+import unittest
+
+import profiling
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+def failing():
+    busy(1000)
+    raise ValueError()
+
+class ProfileTest(unittest.TestCase):
+    def test_run_returns_result(self):
+        profile = profiling.Profile()
+        self.assertEqual(profile.run(busy, 10), 285)
+        self.assertTrue('busy' in profile.summary())
+
+    def test_stats_after_failure(self):
+        profile = profiling.Profile()
+        self.assertRaises(ValueError, profile.run, failing)
+        stats = marshal.loads(profile.dump())
+        self.assertTrue(any(name == 'failing'
+                            for _, _, name in stats.keys()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+from datetime import datetime
+from pytz import timezone
+
+import stats
+
+class FakeTrip:
+    def __init__(self, start_station, end_station, start_time=None,
+                 duration=600):
+        self.start_station = start_station
+        self.end_station = end_station
+        self.start_time = start_time or datetime(2015, 1, 5, 8)
+        self.duration = duration
+
+class FakeStation:
+    def __init__(self, name):
+        self.name = name
+
+class RideStatsTest(unittest.TestCase):
+    def test_buckets(self):
+        ride_stats = stats.RideStats()
+        ride_stats.add(FakeTrip(1, 2, datetime(2015, 1, 5, 8)), 1000, {})
+        ride_stats.add(FakeTrip(2, 1, datetime(2015, 1, 5, 18)), 1200, {})
+        ride_stats.add(FakeTrip(1, 2, datetime(2015, 2, 2, 8)), 1000, {})
+        self.assertEqual(ride_stats.totals, [3, 3200, 1800])
+        self.assertEqual(ride_stats.week_bucket(datetime(2015, 1, 11)),
+                         [2, 2200, 1200])
+        self.assertEqual(ride_stats.month_bucket(datetime(2015, 1, 31)),
+                         [2, 2200, 1200])
+        self.assertEqual(ride_stats.week_bucket(datetime(2015, 1, 12)),
+                         [0, 0, 0])
+        self.assertTrue(ride_stats.changed)
+
+    def test_bucket_keys(self):
+        self.assertEqual(stats.RideStats.week(datetime(2015, 1, 1)),
+                         '2015-W01')
+        self.assertEqual(stats.RideStats.week(datetime(2016, 1, 1)),
+                         '2015-W53')
+        self.assertEqual(stats.RideStats.month(datetime(2015, 1, 1)),
+                         '2015-01')
+
+    def test_local_now_matches_eastern_time(self):
+        eastern = timezone('US/Eastern')
+        start = 1420070400
+        # Every 30 minutes over 2015, through both daylight saving changes.
+        for timestamp in range(start, start + 365 * 24 * 3600, 1800):
+            expected = datetime.fromtimestamp(timestamp, eastern)
+            self.assertEqual(stats.RideStats.local_now(timestamp),
+                             expected.replace(tzinfo=None))
+
+    def test_keeps_latest_weeks(self):
+        ride_stats = stats.RideStats()
+        for week in range(stats.RideStats.MAX_WEEKS + 3):
+            start_time = datetime.fromordinal(
+                datetime(2010, 1, 4).toordinal() + week * 7)
+            ride_stats.add(FakeTrip(1, 2, start_time), 1000, {})
+        self.assertEqual(len(ride_stats.weeks), stats.RideStats.MAX_WEEKS)
+        self.assertFalse('2010-W01' in ride_stats.weeks)
+        self.assertEqual(ride_stats.totals[0], stats.RideStats.MAX_WEEKS + 3)
+
+    def test_top_pairs_named_by_station(self):
+        ride_stats = stats.RideStats()
+        stations = {1: FakeStation('A'), 2: FakeStation('B')}
+        for pair in [(1, 2), (1, 2), (2, 1), (2, 3)]:
+            ride_stats.add(FakeTrip(*pair), 1000, stations)
+        self.assertEqual(ride_stats.top_pairs(1), [('A to B', 2)])
+        self.assertEqual(sorted(ride_stats.top_pairs(3)[1:]),
+                         [('B to 3', 1), ('B to A', 1)])
+
+    def test_new_pairs_counted_once_full(self):
+        ride_stats = stats.RideStats()
+        for i in range(stats.RideStats.MAX_PAIRS):
+            for ride in range(2):
+                ride_stats.add(FakeTrip(i, 1000), 1000, {})
+        for ride in range(50):
+            ride_stats.add(FakeTrip(5000, 1), 1000, {})
+        self.assertEqual(len(ride_stats.pairs), stats.RideStats.MAX_PAIRS)
+        self.assertEqual(ride_stats.top_pairs(1), [('5000 to 1', 50)])
+
+    def test_interleaved_new_pairs_counted_once_full(self):
+        ride_stats = stats.RideStats()
+        for i in range(stats.RideStats.MAX_PAIRS):
+            ride_stats.add(FakeTrip(i, 1000), 1000, {})
+        for ride in range(10):
+            ride_stats.add(FakeTrip(7, 8), 1000, {})
+            ride_stats.add(FakeTrip(8, 7), 1000, {})
+        self.assertEqual(sorted(ride_stats.top_pairs(2)),
+                         [('7 to 8', 10), ('8 to 7', 10)])
+
+    def test_restored(self):
+        ride_stats = stats.RideStats()
+        ride_stats.add(FakeTrip(1, 2), 1000, {})
+        restored = stats.RideStats(ride_stats.totals, ride_stats.weeks,
+                                   ride_stats.months, ride_stats.pairs)
+        self.assertFalse(restored.changed)
+        restored.add(FakeTrip(1, 2), 1000, {})
+        self.assertEqual(restored.totals, [2, 2000, 1200])
+        self.assertEqual(restored.top_pairs(1), [('1 to 2', 2)])
+
+if __name__ == '__main__':
+    unittest.main()
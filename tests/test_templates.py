@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import templates
+
+class TemplatesTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = (templates.TEMPLATE_DIR, templates.COMPILED_DIR,
+                     templates.MANIFEST)
+        templates.TEMPLATE_DIR = tempfile.mkdtemp()
+        templates.COMPILED_DIR = os.path.join(templates.TEMPLATE_DIR,
+                                              'compiled_templates')
+        templates.MANIFEST = os.path.join(templates.COMPILED_DIR,
+                                          'manifest.json')
+        self.write('page.html', 'v1 {{ name }}')
+
+    def tearDown(self):
+        shutil.rmtree(templates.TEMPLATE_DIR)
+        (templates.TEMPLATE_DIR, templates.COMPILED_DIR,
+         templates.MANIFEST) = self.dirs
+
+    def write(self, name, source):
+        with open(os.path.join(templates.TEMPLATE_DIR, name), 'w') as f:
+            f.write(source)
+
+    def render(self):
+        env = templates.environment()
+        return env.get_template('page.html').render(name='<b>')
+
+    def test_sources_without_compiled_templates(self):
+        self.assertEqual(self.render(), 'v1 &lt;b&gt;')
+
+    def test_compiled_templates(self):
+        templates.compile_templates()
+        self.assertTrue(templates._is_compiled())
+        self.assertEqual(self.render(), 'v1 &lt;b&gt;')
+
+    def test_stale_compiled_templates_ignored(self):
+        templates.compile_templates()
+        self.write('page.html', 'v2 {{ name }}')
+        self.assertFalse(templates._is_compiled())
+        self.assertEqual(self.render(), 'v2 &lt;b&gt;')
+
+    def test_new_template_makes_compiled_templates_stale(self):
+        templates.compile_templates()
+        self.write('other.html', '')
+        self.assertFalse(templates._is_compiled())
+
+if __name__ == '__main__':
+    unittest.main()